@@ -1,26 +1,161 @@
 import os
+import sys
+import atexit
 import time
 import json
 import re
+import html
+import codecs
+import csv
+import difflib
+import fcntl
+import hashlib
+import lzma
+import zlib
+import signal
+import smtplib
+import socketserver
+import sqlite3
+import argparse
+import subprocess
+import tempfile
 import threading
-from collections import deque
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, CancelledError, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
 from datetime import datetime
-from functools import wraps
+from email.message import EmailMessage
+from functools import partial, wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+from html.parser import HTMLParser
 
 import requests
-from bs4 import BeautifulSoup
-from flask import Flask, request, redirect, url_for, render_template_string, session, jsonify
+from flask import Flask, Response, request, redirect, url_for, render_template_string, session, jsonify
 
 URL = "https://www.caretrust.mv/Home/TokenStatus"
 
 # Telegram (optional, but required for notifications/commands)
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 CHAT_ID = os.environ.get("CHAT_ID")  # can be group id (-100...) or user id
+# Extra chats allowed to subscribe via commands (comma separated ids, or "*" for anyone)
+ALLOWED_CHATS = {c.strip() for c in os.environ.get("ALLOWED_CHATS", "").split(",") if c.strip()}
 
 # Polling / runtime
 POLL_SECONDS = int(os.environ.get("POLL_SECONDS", "15"))
 STATE_PATH = os.environ.get("STATE_PATH", "/app/data/caretrust_state.json")
 TIMEOUT = int(os.environ.get("TIMEOUT", "20"))
+DB_PATH = os.environ.get("DB_PATH", os.path.join(os.path.dirname(STATE_PATH), "caretrust.db"))
+
+# Sources: JSON list in SOURCES (or a file at SOURCES_PATH). Each entry:
+# {"id": "male", "url": "...", "name": "...", "parser": "lines", "poll_seconds": 15, "concurrency": 1}
+# Without either, a single source for URL is used.
+SOURCES_JSON = os.environ.get("SOURCES", "")
+SOURCES_PATH = os.environ.get("SOURCES_PATH", "")
+DEFAULT_SOURCE = os.environ.get("DEFAULT_SOURCE", "caretrust")
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", "4"))  # sources fetched concurrently
+STREAM_CHUNK = int(os.environ.get("STREAM_CHUNK", "8192"))  # read size for "stream" sources
+
+# Politeness: a token bucket per upstream host, shared by every thread and process through the store.
+# HOST_BUDGETS overrides it per host: "www.caretrust.mv=0.2:2,other.example=1:5" (rate/s:burst)
+FETCH_RATE = float(os.environ.get("FETCH_RATE", "0.5"))  # requests/second per host
+FETCH_BURST = float(os.environ.get("FETCH_BURST", "3"))
+HOST_BUDGETS = {
+    host.strip(): tuple(float(x) for x in budget.split(":"))
+    for host, budget in (e.split("=", 1) for e in os.environ.get("HOST_BUDGETS", "").split(",") if "=" in e)
+}
+
+# Read-only board API (/api/board): public unless BOARD_TOKEN is set
+BOARD_TOKEN = os.environ.get("BOARD_TOKEN", "")
+BOARD_MAX_AGE = int(os.environ.get("BOARD_MAX_AGE", "5"))  # Cache-Control max-age
+BOARD_WAIT_MAX = int(os.environ.get("BOARD_WAIT_MAX", "30"))  # long-poll cap (seconds)
+BOARD_WAITERS = int(os.environ.get("BOARD_WAITERS", "2"))  # long polls held at once per web process
+
+# Warm restart checkpoint (board snapshots, pending messages, recent events)
+CHECKPOINT_PATH = os.environ.get("CHECKPOINT_PATH", os.path.join(os.path.dirname(STATE_PATH), "checkpoint.json"))
+CHECKPOINT_SECONDS = int(os.environ.get("CHECKPOINT_SECONDS", "5"))
+CHECKPOINT_EVENTS = int(os.environ.get("CHECKPOINT_EVENTS", "1000"))  # only used without EVENT_SPILL
+OUTBOX_MAX_TRIES = int(os.environ.get("OUTBOX_MAX_TRIES", "5"))
+
+# Outbox scheduling: priority classes, round robin across chats, global and per-chat pacing
+OUTBOX_RATE = float(os.environ.get("OUTBOX_RATE", "25"))  # messages/second overall (Telegram allows ~30)
+OUTBOX_CHAT_INTERVAL = float(os.environ.get("OUTBOX_CHAT_INTERVAL", "1"))  # seconds between messages to one chat
+OUTBOX_SENDERS = int(os.environ.get("OUTBOX_SENDERS", "4"))  # concurrent sends
+OUTBOX_MAX_QUEUE = int(os.environ.get("OUTBOX_MAX_QUEUE", "10000"))  # past this only urgent messages are queued
+
+# Other notifier backends (a subscription can pick one with /notify); NOTIFY_BATCH messages per call/email
+NOTIFY_BATCH = int(os.environ.get("NOTIFY_BATCH", "20"))
+WEBHOOK_ALLOW = [u.strip() for u in os.environ.get("WEBHOOK_ALLOW", "").split(",") if u.strip()]  # base URLs: exact scheme/host/port, path prefix
+WEBHOOK_TOKEN = os.environ.get("WEBHOOK_TOKEN", "")  # sent as a Bearer token
+WEBHOOK_RATE = float(os.environ.get("WEBHOOK_RATE", "10"))
+SMTP_HOST = os.environ.get("SMTP_HOST", "")
+SMTP_PORT = int(os.environ.get("SMTP_PORT", "587"))
+SMTP_USER = os.environ.get("SMTP_USER", "")
+SMTP_PASS = os.environ.get("SMTP_PASS", "")
+SMTP_FROM = os.environ.get("SMTP_FROM", "caretrust-watch@localhost")
+SMTP_STARTTLS = os.environ.get("SMTP_STARTTLS", "1") == "1"
+SMTP_RATE = float(os.environ.get("SMTP_RATE", "2"))
+
+# Live board: one pinned message per chat, edited at most once per LIVE_DEBOUNCE seconds
+LIVE_DEBOUNCE = int(os.environ.get("LIVE_DEBOUNCE", "10"))
+# "/alertat 45" fires a separate message once the room is within ALERT_MARGIN tokens
+ALERT_MARGIN = int(os.environ.get("ALERT_MARGIN", "3"))
+
+# Digest mode: "/digest 5" batches a chat's changes into one message per 5 minutes
+DIGEST_MAX_MINUTES = int(os.environ.get("DIGEST_MAX_MINUTES", "240"))
+
+# Circuit breakers: open after N consecutive upstream failures, probe again after RESET seconds
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", "3"))
+BREAKER_RESET = int(os.environ.get("BREAKER_RESET", "60"))
+
+# Room labels: "Room 9", "room09" and "RM 09" all name the same room
+ROOM_LABEL_PATTERN = os.environ.get("ROOM_LABEL_PATTERN", r"\b(?:room|rm)\.?\s*-?\s*\d{1,3}\b")
+ROOM_ALIASES = {"rm": "room"}
+
+# Parser self-check: hold back boards whose values stop looking like tokens
+VALUE_PATTERN = os.environ.get("VALUE_PATTERN", r"[A-Z]{0,3}[-\s]?\d{1,5}|-+|n/?a|closed|none")
+SELFCHECK_MIN_RATE = float(os.environ.get("SELFCHECK_MIN_RATE", "0.5"))  # share of rooms that must look valid
+SELFCHECK_POLLS = int(os.environ.get("SELFCHECK_POLLS", "3"))  # polls in a row to quarantine / recover
+ADMIN_CHATS = [c.strip() for c in os.environ.get("ADMIN_CHATS", CHAT_ID or "").split(",") if c.strip()]
+
+# Analytics: hourly per-room rollups, folded in as the watcher sees advances
+ROLLUP_DAYS = int(os.environ.get("ROLLUP_DAYS", "400"))  # buckets older than this are dropped
+ROLLUP_MAX_GAP = int(os.environ.get("ROLLUP_MAX_GAP", "3600"))  # longer pauses are idle time, not service
+
+# Room history and alert deliveries (for /export); rows older than this are dropped
+HISTORY_DAYS = int(os.environ.get("HISTORY_DAYS", "400"))
+EXPORT_BATCH = int(os.environ.get("EXPORT_BATCH", "500"))  # rows per streamed chunk
+PRUNE_SECONDS = int(os.environ.get("PRUNE_SECONDS", "3600"))  # how often the watcher drops expired rows
+
+# Raw page archive (content-addressed, compressed); empty ARCHIVE_DIR disables it
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "")
+ARCHIVE_MAX_MB = float(os.environ.get("ARCHIVE_MAX_MB", "50"))
+ARCHIVE_CODEC = os.environ.get("ARCHIVE_CODEC", "lzma")  # lzma | zlib
+
+# On-demand refresh (/status, dashboard button): snapshots younger than this are reused
+REFRESH_MIN_AGE = float(os.environ.get("REFRESH_MIN_AGE", "5"))
+
+# Optional process pool for BeautifulSoup parsing (0 = parse inline in the watcher)
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", "0"))
+PARSE_QUEUE = int(os.environ.get("PARSE_QUEUE", "4"))  # max parses queued/running at once
+
+# "thread": watcher runs inside the web process (dev server).
+# "process": a dedicated watcher process; web workers only read the shared store.
+WATCHER_MODE = os.environ.get("WATCHER_MODE", "thread")
+
+# Production server (python app.py serve)
+WEB_WORKERS = int(os.environ.get("WEB_WORKERS", "2"))
+WEB_THREADS = int(os.environ.get("WEB_THREADS", "4"))
+
+# Event log: in-memory ring, optionally spilled to the SQLite store
+EVENT_LOG_SIZE = int(os.environ.get("EVENT_LOG_SIZE", "5000"))
+EVENT_PAGE_SIZE = int(os.environ.get("EVENT_PAGE_SIZE", "100"))
+EVENT_SPILL = os.environ.get("EVENT_SPILL", "0") == "1" or WATCHER_MODE == "process"
 
 # Dashboard auth
 DASH_USER = os.environ.get("DASH_USER", "admin")
@@ -30,10 +165,43 @@ SECRET_KEY = os.environ.get("SECRET_KEY", "")
 # Session expiry minutes (displayed + enforced by cookie lifetime)
 SESSION_TIMEOUT_MIN = int(os.environ.get("SESSION_TIMEOUT_MIN", "30"))
 
+# Sampling profiler (admin only; nothing runs unless a capture is in progress)
+PROFILE_MAX_SECONDS = int(os.environ.get("PROFILE_MAX_SECONDS", "120"))
+PROFILE_INTERVAL_MS = int(os.environ.get("PROFILE_INTERVAL_MS", "10"))
+
 API_BASE = f"https://api.telegram.org/bot{BOT_TOKEN}" if BOT_TOKEN else None
 
-LOG = deque(maxlen=400)
-LOCK = threading.Lock()
+# Settings that can be changed while running (admin page, /set, CONFIG_PATH): name -> (type, min, max)
+TUNABLES = {
+    "POLL_SECONDS": (int, 2, 3600),
+    "TIMEOUT": (int, 1, 120),
+    "URL": (str, None, None),
+    "FETCH_WORKERS": (int, 1, 64),
+    "FETCH_RATE": (float, 0.001, 100),
+    "FETCH_BURST": (float, 1, 100),
+    "REFRESH_MIN_AGE": (float, 0, 600),
+    "BOARD_MAX_AGE": (int, 0, 3600),
+    "ALERT_MARGIN": (int, 0, 1000),
+    "LIVE_DEBOUNCE": (int, 1, 600),
+    "DIGEST_MAX_MINUTES": (int, 1, 1440),
+    "BREAKER_FAILURES": (int, 1, 100),
+    "BREAKER_RESET": (int, 1, 3600),
+    "OUTBOX_RATE": (float, 0.1, 1000),
+    "OUTBOX_CHAT_INTERVAL": (float, 0, 60),
+    "OUTBOX_MAX_TRIES": (int, 1, 50),
+    "OUTBOX_MAX_QUEUE": (int, 100, 1_000_000),
+    "NOTIFY_BATCH": (int, 1, 500),
+    "WEBHOOK_RATE": (float, 0.1, 1000),
+    "SMTP_RATE": (float, 0.1, 100),
+    "SELFCHECK_MIN_RATE": (float, 0, 1),
+    "SELFCHECK_POLLS": (int, 1, 100),
+    "VALUE_PATTERN": (str, None, None),
+    "ARCHIVE_MAX_MB": (float, 1, 100_000),
+}
+CONFIG_PATH = os.environ.get("CONFIG_PATH", "")  # optional JSON file of overrides, re-read when it changes
+CONFIG_CHECK_SECONDS = float(os.environ.get("CONFIG_CHECK_SECONDS", "2"))
+
+PROFILE_LOCK = threading.Lock()
 
 app = Flask(__name__, static_folder="static", static_url_path="/static")
 app.secret_key = SECRET_KEY or "dev-only-please-set-SECRET_KEY"
@@ -49,26 +217,950 @@ app.config.update(
 app.permanent_session_lifetime = SESSION_TIMEOUT_MIN * 60
 
 
-def now_str():
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS events (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts REAL NOT NULL, level TEXT NOT NULL, room TEXT, kind TEXT NOT NULL, msg TEXT NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS events_room ON events(room, seq)",
+    "CREATE INDEX IF NOT EXISTS events_kind ON events(kind, seq)",
+    """CREATE TABLE IF NOT EXISTS breakers (
+        name TEXT PRIMARY KEY, state TEXT NOT NULL, failures INTEGER NOT NULL,
+        changed_at REAL NOT NULL, last_error TEXT)""",
+    """CREATE TABLE IF NOT EXISTS archive_blobs (
+        sha TEXT PRIMARY KEY, codec TEXT NOT NULL, raw_bytes INTEGER NOT NULL, stored_bytes INTEGER NOT NULL,
+        first_seen REAL NOT NULL, last_seen REAL NOT NULL)""",
+    """CREATE TABLE IF NOT EXISTS archive (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL NOT NULL, source TEXT NOT NULL,
+        sha TEXT NOT NULL, encoding TEXT)""",
+    "CREATE INDEX IF NOT EXISTS archive_ts ON archive(source, ts)",
+    """CREATE TABLE IF NOT EXISTS room_labels (
+        source TEXT NOT NULL, key TEXT NOT NULL, label TEXT NOT NULL, seen_at REAL NOT NULL,
+        PRIMARY KEY (source, key))""",
+    """CREATE TABLE IF NOT EXISTS rollups (
+        source TEXT NOT NULL, room TEXT NOT NULL, hour INTEGER NOT NULL,
+        advances INTEGER NOT NULL, served INTEGER NOT NULL, gap_sum REAL NOT NULL, gaps INTEGER NOT NULL,
+        PRIMARY KEY (source, hour, room)) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS room_marks (
+        source TEXT NOT NULL, room TEXT NOT NULL, ts REAL NOT NULL, PRIMARY KEY (source, room))""",
+    """CREATE TABLE IF NOT EXISTS history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL NOT NULL, source TEXT NOT NULL,
+        room TEXT NOT NULL, value TEXT)""",
+    "CREATE INDEX IF NOT EXISTS history_ts ON history(ts)",
+    "CREATE INDEX IF NOT EXISTS history_room ON history(room, ts)",
+    """CREATE TABLE IF NOT EXISTS deliveries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, ts REAL NOT NULL, chat TEXT NOT NULL,
+        status TEXT NOT NULL, tries INTEGER NOT NULL, text TEXT NOT NULL,
+        priority INTEGER NOT NULL DEFAULT 1, lag REAL)""",
+    "CREATE INDEX IF NOT EXISTS deliveries_ts ON deliveries(ts)",
+    """CREATE TABLE IF NOT EXISTS settings (
+        name TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at REAL NOT NULL)""",
+    """CREATE TABLE IF NOT EXISTS host_buckets (
+        host TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL, denied INTEGER NOT NULL DEFAULT 0)""",
+    """CREATE TABLE IF NOT EXISTS profile_captures (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, requested_at REAL NOT NULL, seconds REAL NOT NULL,
+        interval REAL NOT NULL, started_at REAL, counts TEXT)""",
+    """CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, dest TEXT NOT NULL, text TEXT NOT NULL, tries INTEGER NOT NULL,
+        priority INTEGER NOT NULL, queued_at REAL NOT NULL, owner TEXT NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS outbox_owner ON outbox(owner)",
+    """CREATE TABLE IF NOT EXISTS refresh_requests (
+        source TEXT PRIMARY KEY, requested_at REAL NOT NULL)""",
+    """CREATE TABLE IF NOT EXISTS board (
+        source TEXT PRIMARY KEY, version INTEGER NOT NULL,
+        fetched_at REAL NOT NULL, changed_at REAL NOT NULL, "values" TEXT NOT NULL)""",
+]
+
+# Columns added after their table first shipped: (table, column, definition)
+MIGRATIONS = [
+    ("deliveries", "priority", "INTEGER NOT NULL DEFAULT 1"),
+    ("deliveries", "lag", "REAL"),
+]
+
+_DB = threading.local()
+
+
+def db():
+    """Per-thread (and per-process, so it is fork safe) SQLite connection."""
+    conn = getattr(_DB, "conn", None)
+    if conn is None or _DB.pid != os.getpid():
+        os.makedirs(os.path.dirname(DB_PATH) or ".", exist_ok=True)
+        conn = sqlite3.connect(DB_PATH, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        for ddl in SCHEMA:
+            conn.execute(ddl)
+        for table, column, ddl in MIGRATIONS:
+            if column not in {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+        _DB.conn, _DB.pid = conn, os.getpid()
+    return conn
+
+
+def coerce_setting(name: str, value):
+    """Validate one override; raises ValueError with a readable reason."""
+    if name not in TUNABLES:
+        raise ValueError(f"{name} is not a runtime setting")
+    typ, lo, hi = TUNABLES[name]
+    try:
+        v = typ(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be {typ.__name__}") from None
+    if (lo is not None and v < lo) or (hi is not None and v > hi):
+        raise ValueError(f"{name} must be between {lo} and {hi}")
+    if name == "URL" and not v.startswith(("http://", "https://")):
+        raise ValueError("URL must start with http:// or https://")
+    if name == "VALUE_PATTERN":
+        try:
+            re.compile(v)
+        except re.error as e:
+            raise ValueError(f"VALUE_PATTERN: {e}") from None
+    return v
+
+
+class Settings:
+    """
+    Runtime overrides for TUNABLES, layered env < CONFIG_PATH < store (what
+    the admin page and /set write). refresh() is cheap between changes and
+    runs on the watcher tick and before web requests. A change is validated
+    as a whole and swapped into the module globals under one lock, together
+    with what was derived from them (default source URL, breaker limits).
+    CHAT_ID is not among them: the dashboard's chat key, the admin list and
+    whether the command thread runs are all fixed from it at boot.
+    """
+
+    def __init__(self):
+        self.defaults = {name: globals()[name] for name in TUNABLES}
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.checked = 0.0
+        self.overrides = {}
+
+    def read(self) -> dict:
+        raw = {}
+        if CONFIG_PATH:
+            try:
+                with open(CONFIG_PATH, "r", encoding="utf-8") as f:
+                    raw.update(json.load(f))
+            except FileNotFoundError:
+                pass
+        raw.update(db().execute("SELECT name, value FROM settings").fetchall())
+        return raw
+
+    def current_stamp(self):
+        try:
+            mtime = os.stat(CONFIG_PATH).st_mtime if CONFIG_PATH else None
+        except OSError:
+            mtime = None
+        return mtime, tuple(db().execute("SELECT COUNT(*), MAX(updated_at) FROM settings").fetchone())
+
+    def refresh(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self.checked < CONFIG_CHECK_SECONDS:
+            return
+        self.checked = now
+        stamp = self.current_stamp()
+        if stamp == self.stamp:
+            return
+        overrides = {}
+        for name, value in self.read().items():
+            try:
+                overrides[name] = coerce_setting(name, value)
+            except ValueError as e:
+                log_event(f"Ignoring setting: {e}", level="warning", kind="config")
+        with self.lock:
+            values = {name: overrides.get(name, default) for name, default in self.defaults.items()}
+            changed = sorted(name for name, v in values.items() if globals()[name] != v)
+            globals().update(values)
+            self.apply(changed)
+            first, self.stamp, self.overrides = self.stamp is None, stamp, overrides
+        if changed and not first:
+            log_event("Settings applied: " + ", ".join(f"{n}={values[n]}" for n in changed), kind="config")
+
+    def apply(self, changed):
+        if "URL" in changed and not (SOURCES_JSON or SOURCES_PATH) and DEFAULT_SOURCE in SOURCES:
+            SOURCES[DEFAULT_SOURCE].url = URL
+        if "BREAKER_FAILURES" in changed or "BREAKER_RESET" in changed:
+            for b in list(BREAKERS.values()):
+                b.threshold, b.reset = BREAKER_FAILURES, BREAKER_RESET
+
+    def set(self, name: str, value):
+        """Validate and store an override (None clears it); applied right away."""
+        if value is None:
+            db().execute("DELETE FROM settings WHERE name = ?", (name,))
+        else:
+            v = coerce_setting(name, value)
+            db().execute("INSERT OR REPLACE INTO settings VALUES (?, ?, ?)", (name, str(v), time.time()))
+        self.refresh(force=True)
+
+    def rows(self):
+        return [
+            {"name": name, "value": globals()[name], "default": self.defaults[name],
+             "override": name in self.overrides, "type": TUNABLES[name][0].__name__,
+             "min": TUNABLES[name][1], "max": TUNABLES[name][2]}
+            for name in TUNABLES
+        ]
+
+
+class Clock:
+    """Wall clock used by change detection; replay swaps in a simulated one."""
+
+    def time(self) -> float:
+        return time.time()
+
+
+class ReplayClock(Clock):
+    def __init__(self, start: float):
+        self.now = start
+
+    def time(self) -> float:
+        return self.now
+
+    def advance_to(self, ts: float):
+        self.now = max(self.now, ts)
+
+
+CLOCK = Clock()
+
+
+def now_str(ts: float | None = None):
+    return datetime.fromtimestamp(ts if ts is not None else CLOCK.time()).strftime("%Y-%m-%d %H:%M:%S")
+
+
+EVENT_FIELDS = ("seq", "ts", "level", "room", "kind", "msg")
+
+
+class EventLog:
+    """
+    Fixed-capacity ring of (seq, ts, level, room, kind, msg) tuples.
+    seq is monotonically increasing and doubles as the pagination cursor.
+    """
+
+    __slots__ = ("size", "buf", "seq", "lock")
+
+    def __init__(self, size: int):
+        self.size = max(1, size)
+        self.buf = [None] * self.size
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def append(self, rec):
+        with self.lock:
+            if rec[0] is None:
+                rec = (self.seq + 1,) + rec[1:]
+            self.seq = rec[0]
+            self.buf[self.seq % self.size] = rec
+        return rec
+
+    def oldest(self):
+        return max(1, self.seq - self.size + 1)
+
+    def page(self, before=None, limit=EVENT_PAGE_SIZE, room=None, kind=None, level=None):
+        """Newest-first records with seq < before. Returns (records, next_cursor)."""
+        out = []
+        with self.lock:
+            s = self.seq if before is None else min(before - 1, self.seq)
+            stop = self.oldest()
+            while s >= stop and len(out) < limit:
+                rec = self.buf[s % self.size]
+                if rec is not None and rec[0] == s \
+                        and (room is None or rec[3] == room) \
+                        and (kind is None or rec[4] == kind) \
+                        and (level is None or rec[2] == level):
+                    out.append(rec)
+                s -= 1
+        return out, (s + 1 if s >= stop else None)
+
 
+EVENTS = EventLog(EVENT_LOG_SIZE)
 
-def log_event(msg: str):
-    with LOCK:
-        LOG.appendleft(f"[{now_str()}] {msg}")
 
+def log_event(msg: str, level: str = "info", room: str | None = None, kind: str = "event"):
+    rec = (None, CLOCK.time(), level, room, kind, msg)
+    if EVENT_SPILL:
+        try:
+            cur = db().execute(
+                "INSERT INTO events (ts, level, room, kind, msg) VALUES (?, ?, ?, ?, ?)", rec[1:]
+            )
+            rec = (cur.lastrowid,) + rec[1:]
+        except sqlite3.Error:
+            pass
+    EVENTS.append(rec)
 
-def send_telegram(text: str):
-    if not API_BASE or not CHAT_ID:
+
+def load_events():
+    """Seed the ring from the spill table so history survives restarts."""
+    if not EVENT_SPILL:
         return
+    rows = db().execute(
+        "SELECT seq, ts, level, room, kind, msg FROM events ORDER BY seq DESC LIMIT ?", (EVENTS.size,)
+    ).fetchall()
+    for row in reversed(rows):
+        EVENTS.append(tuple(row))
+
+
+def events_page(before=None, limit=EVENT_PAGE_SIZE, room=None, kind=None, level=None):
+    """Ring first; once the cursor walks past the ring, continue from the spill table."""
+    if WATCHER_MODE == "process":
+        # The watcher lives in another process; only the spill table is authoritative
+        recs, cursor = [], None
+    else:
+        recs, cursor = EVENTS.page(before, limit, room, kind, level)
+    if not EVENT_SPILL or len(recs) >= limit:
+        return recs, cursor
+
+    start = EVENTS.oldest() if EVENTS.seq and WATCHER_MODE != "process" else 1 << 62
+    if before is not None:
+        start = min(start, before)
+    sql = "SELECT seq, ts, level, room, kind, msg FROM events WHERE seq < ?"
+    args = [start]
+    for col, val in (("room", room), ("kind", kind), ("level", level)):
+        if val is not None:
+            sql += f" AND {col} = ?"
+            args.append(val)
+    sql += " ORDER BY seq DESC LIMIT ?"
+    args.append(limit - len(recs))
+    rows = [tuple(r) for r in db().execute(sql, args).fetchall()]
+    recs += rows
+    return recs, (recs[-1][0] if rows and len(recs) >= limit else None)
+
+
+def format_event(rec) -> str:
+    return f"[{now_str(rec[1])}] {rec[5]}"
+
+
+class BreakerOpen(Exception):
+    """The upstream's circuit is open; the call was not attempted."""
+
+
+class OverBudget(BreakerOpen):
+    """The host's request budget is spent; callers serve the last snapshot instead."""
+
+
+class UpstreamError(RuntimeError):
+    """An HTTP upstream answered with an error status (kept on .status for upstream_failure)."""
+
+    def __init__(self, msg, status=None):
+        super().__init__(msg)
+        self.status = status
+
+
+class TelegramError(UpstreamError):
+    pass
+
+
+def upstream_failure(exc) -> bool:
+    """
+    True for errors meaning the upstream is down or overloaded (connection
+    problems, timeouts, 429, 5xx, SMTP 4xx). Bad requests and parse bugs
+    don't count: the upstream answered, retrying won't help and it shouldn't
+    trip anything.
+    """
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout,
+                        smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return 400 <= exc.smtp_code < 500  # "try again later"; 5xx is a refusal
+    status = getattr(getattr(exc, "response", None), "status_code", None) or getattr(exc, "status", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    # raw socket errors (refused, reset, socket.timeout); requests and smtplib
+    # errors are OSErrors too, but the rest of them are about the request
+    return isinstance(exc, OSError) and not isinstance(exc, (requests.RequestException, smtplib.SMTPException))
+
+
+class CircuitBreaker:
+    """closed -> (N upstream failures) -> open -> (RESET seconds) -> half-open -> one probe -> closed/open"""
+
+    def __init__(self, name: str, failures: int | None = None, reset: int | None = None):
+        # BREAKER_* are read once here; Settings.apply patches live breakers when they change
+        self.name = name
+        self.threshold = BREAKER_FAILURES if failures is None else failures
+        self.reset = BREAKER_RESET if reset is None else reset
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.last_error = ""
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset:
+                self._set("half-open")
+            if self.state == "half-open":
+                if self.probing:
+                    return False
+                self.probing = True
+                return True
+            return self.state == "closed"
+
+    def success(self):
+        with self.lock:
+            self.failures, self.probing = 0, False
+            if self.state != "closed":
+                self._set("closed")
+
+    def release(self):
+        # the call ended without saying anything about the upstream's health
+        with self.lock:
+            self.probing = False
+
+    def failure(self, exc):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            self.last_error = str(exc)[:300]
+            if self.state == "half-open" or (self.state == "closed" and self.failures >= self.threshold):
+                self.opened_at = time.monotonic()
+                self._set("open")
+
+    def call(self, fn, *args, **kwargs):
+        if not self.allow():
+            raise BreakerOpen(self.name)
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            # includes OverBudget: refused before reaching the upstream, so it only frees the probe
+            if upstream_failure(e):
+                self.failure(e)
+            else:
+                self.release()
+            raise
+        self.success()
+        return result
+
+    def _set(self, state: str):
+        # caller holds self.lock
+        self.state = state
+        level = "info" if state == "closed" else "warning"
+        log_event(f"Circuit {self.name}: {state}" + (f" ({self.last_error})" if state == "open" else ""),
+                  level=level, kind="breaker")
+        try:
+            db().execute(
+                "INSERT OR REPLACE INTO breakers (name, state, failures, changed_at, last_error) VALUES (?, ?, ?, ?, ?)",
+                (self.name, state, self.failures, time.time(), self.last_error),
+            )
+        except sqlite3.Error:
+            pass
+
+
+BREAKERS = {}
+_BREAKERS_LOCK = threading.Lock()
+
+
+def breaker(name: str) -> CircuitBreaker:
+    with _BREAKERS_LOCK:
+        if name not in BREAKERS:
+            BREAKERS[name] = CircuitBreaker(name)
+        return BREAKERS[name]
+
+
+def breaker_rows():
+    """Breaker states for the dashboard, from the store so it works across processes."""
+    rows = db().execute("SELECT name, state, failures, changed_at, last_error FROM breakers ORDER BY name").fetchall()
+    return [dict(zip(("name", "state", "failures", "changed_at", "last_error"), r)) for r in rows]
+
+
+def send_telegram(text: str, chat_id=None) -> bool:
+    """Returns False only when the send failed and is worth retrying."""
+    chat_id = str(chat_id or CHAT_ID or "")
+    if not API_BASE or not chat_id.lstrip("-").isdigit():
+        return True
+    tg = breaker("telegram")
+    if not tg.allow():
+        return False
     try:
-        requests.post(
+        r = requests.post(
             f"{API_BASE}/sendMessage",
-            data={"chat_id": str(CHAT_ID), "text": text},
+            data={"chat_id": chat_id, "text": text},
             timeout=TIMEOUT,
         )
     except Exception as e:
-        log_event(f"Telegram send error: {e}")
+        if upstream_failure(e):
+            tg.failure(e)
+        else:
+            tg.release()
+        log_event(f"Telegram send error: {e}", level="error", kind="telegram")
+        return False
+    if r.status_code == 429 or r.status_code >= 500:
+        tg.failure(TelegramError(f"HTTP {r.status_code}", r.status_code))
+        log_event(f"Telegram send error: HTTP {r.status_code}", level="error", kind="telegram")
+        return False
+    if not r.ok:
+        tg.release()
+        log_event(f"Telegram rejected message to {chat_id}: HTTP {r.status_code}", level="error", kind="telegram")
+        return True
+    tg.success()
+    return True
+
+
+def telegram_api(method: str, **data):
+    """Raw Bot API call; returns the "result" field, raises on any failure."""
+
+    def call():
+        r = requests.post(f"{API_BASE}/{method}", data=data, timeout=TIMEOUT)
+        try:
+            body = r.json()
+        except ValueError:
+            body = {}
+        if not body.get("ok"):
+            raise TelegramError(f"{method}: {body.get('description') or r.status_code}", r.status_code)
+        return body["result"]
+
+    return breaker("telegram").call(call)
+
+
+# Outbox priorities, most urgent first
+URGENT, CHANGE, REPLY = 0, 1, 2
+PRIORITY_NAMES = ("urgent", "change", "reply")
+
+
+class Notifier(ABC):
+    """
+    One output channel. send() gets up to `batch` messages for one address
+    and returns False only when the send failed and is worth retrying.
+    Queueing, pacing, batching and retries all live in the Outbox.
+    """
+
+    name = ""
+    rate = 1.0  # sends/second across all addresses
+    batch = 1
+
+    def enabled(self) -> bool:
+        return True
+
+    def valid(self, address: str) -> bool:
+        return bool(address)
+
+    @abstractmethod
+    def send(self, address: str, texts: list) -> bool:
+        ...
+
+
+class TelegramNotifier(Notifier):
+    name = "telegram"
+
+    def enabled(self):
+        return bool(API_BASE)
+
+    @property
+    def rate(self):
+        return OUTBOX_RATE
+
+    def valid(self, address):
+        return address.lstrip("-").isdigit()
+
+    def send(self, address, texts):
+        return send_telegram(texts[0], address)
+
+
+class WebhookNotifier(Notifier):
+    """POSTs {"messages": [{"text", "ts"}...], "to"} as JSON to an allowed URL."""
+
+    name = "webhook"
+
+    @property
+    def rate(self):
+        return WEBHOOK_RATE
+
+    @property
+    def batch(self):
+        return NOTIFY_BATCH
+
+    def enabled(self):
+        return bool(WEBHOOK_ALLOW)
+
+    @staticmethod
+    def origin(url: str):
+        """(scheme, host, port, path) with the default port filled in; None if unparseable."""
+        try:
+            u = urlsplit(url)
+            port = u.port or {"http": 80, "https": 443}.get(u.scheme)
+        except ValueError:
+            return None
+        if u.scheme not in ("http", "https") or not u.hostname:
+            return None
+        return u.scheme, u.hostname.lower(), port, u.path or "/"
+
+    def valid(self, address):
+        # exact scheme, host and port: a plain prefix would let https://ok.example.evil.com through
+        target = self.origin(address)
+        if target is None:
+            return False
+        for allowed in WEBHOOK_ALLOW:
+            rule = self.origin(allowed)
+            if rule and rule[:3] == target[:3]:
+                base = rule[3].rstrip("/")
+                if not base or target[3] == base or target[3].startswith(base + "/"):
+                    return True
+        return False
+
+    def send(self, address, texts):
+        headers = {"Authorization": f"Bearer {WEBHOOK_TOKEN}"} if WEBHOOK_TOKEN else {}
+        payload = {"to": address, "messages": [{"text": t, "ts": time.time()} for t in texts]}
+
+        def post():
+            # raised inside the breaker call, so it sees 429/5xx as failures and 4xx as neither
+            r = requests.post(address, json=payload, headers=headers, timeout=TIMEOUT)
+            if not r.ok:
+                raise UpstreamError(f"HTTP {r.status_code}", r.status_code)
+
+        try:
+            breaker(self.name).call(post)
+        except UpstreamError as e:
+            if upstream_failure(e):
+                log_event(f"Webhook error: {e}", level="error", kind="notify")
+                return False
+            log_event(f"Webhook rejected message to {address}: {e}", level="error", kind="notify")
+        except Exception as e:
+            log_event(f"Webhook error: {e}", level="error", kind="notify")
+            return False
+        return True
+
+
+class SmtpNotifier(Notifier):
+    """One email per batch, messages separated by blank lines."""
+
+    name = "email"
+
+    @property
+    def rate(self):
+        return SMTP_RATE
+
+    @property
+    def batch(self):
+        return NOTIFY_BATCH
+
+    def enabled(self):
+        return bool(SMTP_HOST)
+
+    def valid(self, address):
+        return re.fullmatch(r"[^@\s]+@[^@\s]+\.[^@\s]+", address) is not None
+
+    def deliver(self, msg):
+        with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=TIMEOUT) as smtp:
+            if SMTP_STARTTLS:
+                smtp.starttls()
+            if SMTP_USER:
+                smtp.login(SMTP_USER, SMTP_PASS)
+            smtp.send_message(msg)
+
+    def send(self, address, texts):
+        msg = EmailMessage()
+        msg["From"], msg["To"] = SMTP_FROM, address
+        first = texts[0].splitlines()[0] if texts[0] else "CareTrust"
+        msg["Subject"] = first if len(texts) == 1 else f"{first} (+{len(texts) - 1} more)"
+        msg.set_content("\n\n".join(texts))
+        try:
+            breaker(self.name).call(self.deliver, msg)
+        except smtplib.SMTPRecipientsRefused as e:
+            log_event(f"Email to {address} refused: {e}", level="error", kind="notify")
+            return True
+        except Exception as e:
+            log_event(f"Email error: {e}", level="error", kind="notify")
+            return False
+        return True
+
+
+NOTIFIERS = {n.name: n for n in (TelegramNotifier(), WebhookNotifier(), SmtpNotifier())}
+
+
+def split_dest(dest: str):
+    """Outbox destination -> (notifier, address). Plain chat ids are Telegram."""
+    channel, sep, address = dest.partition(":")
+    if sep and channel in NOTIFIERS:
+        return NOTIFIERS[channel], address
+    return NOTIFIERS["telegram"], dest
+
+
+def sub_dest(chat, sub) -> str:
+    """Where a subscription's alerts go: its /notify channel (if still enabled), else the chat itself."""
+    dest = sub.get("notify")
+    return dest if dest and split_dest(dest)[0].enabled() else str(chat)
+
+
+def process_token(pid: int | None = None) -> str | None:
+    """
+    "pid:start time" of a running process, None once it is gone. The start
+    time keeps a pid reused after a restart (containers hand out the same
+    few) from passing for its predecessor. Plain "pid" where /proc is missing.
+    """
+    pid = pid or os.getpid()
+    if os.path.exists("/proc/self/stat"):
+        try:
+            with open(f"/proc/{pid}/stat", "r") as f:
+                return f"{pid}:{f.read().rsplit(')', 1)[1].split()[19]}"
+        except (OSError, IndexError):
+            return None
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return None
+    except PermissionError:
+        pass
+    return str(pid)
+
+
+class Outbox:
+    """
+    Messages waiting to go out, for every notifier. Each priority class
+    (turn-near alerts, then change notices and digests, then command
+    replies) keeps a FIFO per destination, and destinations take turns
+    round robin, so one busy room cannot starve the rest. Sends are paced
+    per notifier (its rate) and per destination (OUTBOX_CHAT_INTERVAL), run
+    on OUTBOX_SENDERS threads (started on first use in each process), and
+    notifiers that take batches get everything queued for the destination
+    in one call. Failed sends go back to the front of their queue with
+    backoff. Past OUTBOX_MAX_QUEUE only urgent messages are accepted, so a
+    slow channel pushes back here instead of on the watcher.
+
+    Every queued message is also a row in the `outbox` table, owned by the
+    process that queued it and deleted once it is sent or given up on.
+    Callers queue from inside edit_state(), so an alert is stored before the
+    state change that produced it; recover() hands the rows of a process
+    that is gone (a previous run, a crashed worker) to this one.
+    """
+
+    def __init__(self):
+        self.queues = [OrderedDict() for _ in PRIORITY_NAMES]  # dest -> deque of [dest, text, tries, prio, queued_at, row id]
+        self.ready_at = {}  # dest -> monotonic time it may be sent to again
+        self.inflight = {}  # dest -> items being sent (one call at a time per dest keeps its order)
+        self.next_slot = {}  # notifier name -> monotonic time of its next send
+        self.size = 0
+        self.cond = threading.Condition()
+        self.pid = None
+        self.owner = (None, None)  # (pid, process_token) of the rows this process owns
+
+    def put(self, chat, text: str, priority: int = CHANGE, tries: int = 0, queued_at: float | None = None):
+        self.extend([(chat, text, priority)], tries, queued_at)
+
+    def extend(self, messages, tries: int = 0, queued_at: float | None = None):
+        """Queue (chat, text, priority) messages, stored in one transaction."""
+        items = self.accept([str(chat), text, tries, priority, queued_at or time.time(), None]
+                            for chat, text, priority in messages)
+        if not items:
+            return
+        try:
+            conn = db()
+            conn.execute("BEGIN")
+            try:
+                for item in items:
+                    item[5] = conn.execute(
+                        "INSERT INTO outbox (dest, text, tries, priority, queued_at, owner) VALUES (?, ?, ?, ?, ?, ?)",
+                        (*item[:5], self.token()),
+                    ).lastrowid
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            # still deliver what we can; only the restart guarantee is lost
+            log_event(f"Outbox store error: {e}", level="error", kind="notify")
+            for item in items:
+                item[5] = None
+        self.enqueue(items)
+
+    def accept(self, items) -> list:
+        """The items that can and may be queued; the rest are recorded as skipped or shed."""
+        accepted = []
+        for item in items:
+            notifier, address = split_dest(item[0])
+            if not notifier.enabled() or not notifier.valid(address):
+                # e.g. the "dashboard" chat, or Telegram without BOT_TOKEN: nothing would be sent
+                record_delivery(item[0], item[1], "skipped", 0, item[3], None)
+            elif self.size + len(accepted) >= OUTBOX_MAX_QUEUE and item[3] != URGENT:
+                log_event(f"Outbox full; dropped {PRIORITY_NAMES[item[3]]} message to {item[0]}",
+                          level="warning", kind="notify")
+                record_delivery(item[0], item[1], "shed", 0, item[3], None)
+            else:
+                accepted.append(item)
+        return accepted
+
+    def enqueue(self, items):
+        with self.cond:
+            for item in items:
+                self.queues[item[3]].setdefault(item[0], deque()).append(item)
+            self.size += len(items)
+            self.cond.notify_all()
+        self.start()
+
+    def token(self) -> str:
+        if self.owner[0] != os.getpid():
+            self.owner = (os.getpid(), process_token() or str(os.getpid()))
+        return self.owner[1]
+
+    def forget(self, items, tries: bool = False):
+        """Delete the rows of sent or dropped items (tries=True: store their new try count instead)."""
+        rows = [(item[2], item[5]) if tries else (item[5],) for item in items if item[5] is not None]
+        if not rows:
+            return
+        try:
+            if tries:
+                db().executemany("UPDATE outbox SET tries = ? WHERE id = ?", rows)
+            else:
+                db().executemany("DELETE FROM outbox WHERE id = ?", rows)
+        except sqlite3.Error as e:
+            log_event(f"Outbox store error: {e}", level="error", kind="notify")
+
+    def recover(self) -> int:
+        """Take over the rows of processes that are gone and queue them here; returns how many."""
+        me = self.token()
+        conn = db()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = []
+            for (owner,) in conn.execute("SELECT DISTINCT owner FROM outbox WHERE owner != ?", (me,)).fetchall():
+                pid = owner.split(":", 1)[0]
+                if pid.isdigit() and process_token(int(pid)) == owner:
+                    continue
+                rows += conn.execute(
+                    "SELECT dest, text, tries, priority, queued_at, id FROM outbox WHERE owner = ? ORDER BY id", (owner,)
+                ).fetchall()
+                conn.execute("UPDATE outbox SET owner = ? WHERE owner = ?", (me, owner))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        rows.sort(key=lambda r: r[5])
+        items = [list(r) for r in rows]
+        accepted = self.accept(items)
+        kept = {item[5] for item in accepted}
+        self.forget([item for item in items if item[5] not in kept])
+        self.enqueue(accepted)
+        return len(accepted)
+
+    def start(self):
+        with self.cond:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+        for i in range(max(1, OUTBOX_SENDERS)):
+            threading.Thread(target=self.run, name=f"outbox-{i}", daemon=True).start()
+
+    def take(self):
+        """
+        Block until something may go out: the most urgent class first,
+        destinations in turn. Returns (notifier, address, items).
+        """
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                wait = None
+                for queue in self.queues if self.size else ():
+                    for dest in queue:
+                        if dest in self.inflight:
+                            continue
+                        notifier, address = split_dest(dest)
+                        at = max(self.ready_at.get(dest, 0), self.next_slot.get(notifier.name, 0))
+                        if at > now:
+                            wait = min(wait or at - now, at - now)
+                            continue
+                        items = queue[dest]
+                        batch = [items.popleft() for _ in range(min(len(items), max(1, notifier.batch)))]
+                        if items:
+                            queue.move_to_end(dest)
+                        else:
+                            del queue[dest]
+                        self.size -= len(batch)
+                        self.inflight[dest] = batch
+                        self.next_slot[notifier.name] = max(at, now) + 1 / max(notifier.rate, 0.001)
+                        return notifier, address, batch
+                self.cond.wait(wait)
+
+    def done(self, notifier, batch, sent):
+        """sent: True, False (failed, counts as a try) or None (not attempted, over the shared rate)."""
+        dest = batch[0][0]
+        now = time.monotonic()
+        with self.cond:
+            del self.inflight[dest]
+            if sent is None:
+                self.queues[batch[0][3]].setdefault(dest, deque()).extendleft(reversed(batch))
+                self.size += len(batch)
+                self.ready_at[dest] = now + 1 / max(notifier.rate, 0.001)
+                self.cond.notify_all()
+                return
+            self.ready_at[dest] = now + OUTBOX_CHAT_INTERVAL
+            # forget destinations that have been quiet for a while
+            if len(self.ready_at) > 1000:
+                self.ready_at = {d: t for d, t in self.ready_at.items() if t > now}
+            if not sent:
+                if breaker(notifier.name).state != "closed":
+                    self.ready_at[dest] = now + 5  # outage: wait for the breaker instead of burning tries
+                else:
+                    for item in batch:
+                        item[2] += 1
+                    self.ready_at[dest] = now + min(2 ** batch[0][2], 60)
+                retry = [item for item in batch if item[2] < OUTBOX_MAX_TRIES]
+                if retry:
+                    self.queues[retry[0][3]].setdefault(dest, deque()).extendleft(reversed(retry))
+                    self.size += len(retry)
+            self.cond.notify_all()
+        if sent:
+            self.forget(batch)
+        else:
+            self.forget([item for item in batch if item[2] >= OUTBOX_MAX_TRIES])
+            self.forget([item for item in batch if item[2] < OUTBOX_MAX_TRIES], tries=True)
+        for item in batch:
+            if sent:
+                record_delivery(dest, item[1], "sent", item[2] + 1, item[3], time.time() - item[4])
+            elif item[2] >= OUTBOX_MAX_TRIES:
+                log_event(f"Dropped message to {dest} after {item[2]} tries", level="error", kind="notify")
+                record_delivery(dest, item[1], "dropped", item[2], item[3], None)
+
+    def load(self, items):
+        for chat, text, tries, *rest in items:
+            priority, queued_at = (rest + [CHANGE, None])[:2]
+            self.put(chat, text, int(priority), int(tries), queued_at)
+
+    def run(self):
+        while True:
+            notifier, address, batch = self.take()
+            try:
+                # every web worker and the watcher run senders; the rate is shared through the store
+                if not take_token(f"notify:{notifier.name}", notifier.rate, 1):
+                    sent = None
+                else:
+                    sent = notifier.send(address, [item[1] for item in batch])
+            except Exception as e:
+                log_event(f"{notifier.name} send error: {e}", level="error", kind="notify")
+                sent = False
+            self.done(notifier, batch, sent)
+
+
+OUTBOX = Outbox()
+
+
+def reply(text: str, chat_id=None):
+    """Command replies and notices go through the outbox behind alerts."""
+    OUTBOX.put(chat_id or CHAT_ID, text, REPLY)
+
+
+def record_delivery(chat, text: str, status: str, tries: int, priority: int = CHANGE, lag: float | None = None):
+    try:
+        db().execute(
+            "INSERT INTO deliveries (ts, chat, status, tries, text, priority, lag) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (CLOCK.time(), str(chat), status, tries, text, priority, lag),
+        )
+    except sqlite3.Error as e:
+        log_event(f"Delivery log error: {e}", level="error", kind="notify")
+
+
+def delivery_lag(window: float = 3600) -> list:
+    """Per priority class: sends in the last `window` seconds and their lag percentiles."""
+    rows = db().execute(
+        "SELECT priority, lag FROM deliveries WHERE ts >= ? AND status = 'sent' AND lag IS NOT NULL ORDER BY priority, lag",
+        (CLOCK.time() - window,),
+    ).fetchall()
+    by_class = {}
+    for prio, lag in rows:
+        by_class.setdefault(prio, []).append(lag)
+    stats = []
+    for prio, lags in sorted(by_class.items()):
+        row = {"priority": PRIORITY_NAMES[prio] if prio < len(PRIORITY_NAMES) else str(prio), "sent": len(lags)}
+        for name, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0)):
+            row[name] = round(lags[min(len(lags) - 1, int(q * len(lags)))], 2)
+        stats.append(row)
+    return stats
 
 
 def get_updates(offset=None):
@@ -77,108 +1169,1189 @@ def get_updates(offset=None):
     params = {"timeout": 10}
     if offset is not None:
         params["offset"] = offset
-    r = requests.get(f"{API_BASE}/getUpdates", params=params, timeout=30)
-    r.raise_for_status()
-    return r.json().get("result", [])
 
+    def call():
+        r = requests.get(f"{API_BASE}/getUpdates", params=params, timeout=30)
+        r.raise_for_status()
+        return r.json().get("result", [])
+
+    return breaker("telegram").call(call)
 
-def load_state():
+
+# Chat key used for subscriptions made from the dashboard
+DASH_CHAT = str(CHAT_ID) if CHAT_ID else "dashboard"
+
+
+def new_sub(room=None, enabled=False):
+    return {"enabled": enabled, "room": room, "last_value": None, "current_value": None}
+
+
+def load_state(text: str | None = None):
+    """The state, from `text` (the file's contents, if already read) or the file."""
     try:
-        with open(STATE_PATH, "r", encoding="utf-8") as f:
-            s = json.load(f)
+        if text is None:
+            with open(STATE_PATH, "r", encoding="utf-8") as f:
+                text = f.read()
+        s = json.loads(text)
     except Exception:
         s = {}
-    s.setdefault("enabled", False)
-    s.setdefault("room", None)
-    s.setdefault("last_value", None)
-    s.setdefault("current_value", None)
     s.setdefault("update_offset", None)
+    # chats: {chat_id: {"live": bool, "live_msg_id": int, "live_text": str,
+    #                   "digest": minutes, "digest_since": ts, "pending": {"source|room": [from, to, n]}}}
+    s.setdefault("chats", {})
+    # subs: {chat_id: {source_id: {"enabled", "room", "last_value", "current_value"}}}
+    subs = s.setdefault("subs", {})
+    if "room" in s or "enabled" in s:
+        # single-room state from before sources existed
+        legacy = {k: s.pop(k, None) for k in ("enabled", "room", "last_value", "current_value")}
+        legacy["enabled"] = bool(legacy["enabled"])
+        if legacy["room"]:
+            subs.setdefault(DASH_CHAT, {})[default_source_id()] = legacy
     return s
 
 
-def save_state(state):
-    os.makedirs(os.path.dirname(STATE_PATH), exist_ok=True)
-    with open(STATE_PATH, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+def get_sub(state, chat, source_id):
+    return state["subs"].setdefault(str(chat), {}).setdefault(source_id, new_sub())
 
 
-def fetch_page_text():
-    r = requests.get(URL, timeout=TIMEOUT, headers={"Cache-Control": "no-cache"})
-    r.raise_for_status()
-    soup = BeautifulSoup(r.text, "html.parser")
-    return soup.get_text("\n")
+def iter_subs(state):
+    for chat, by_source in state["subs"].items():
+        for source_id, sub in by_source.items():
+            yield chat, source_id, sub
 
 
-def extract_room_value(page_text: str, room_label: str):
+class SubIndex:
     """
-    Heuristic: find the line containing "Room 09" and return:
-      - value on same line (after the label), else
-      - next non-empty line
+    Column view of the subscriptions for the scheduler: parallel tuples of
+    chat, source and interned room plus an enabled bitmap, instead of a dict
+    per subscription, and the watched rooms per source derived from them.
     """
-    lines = [ln.strip() for ln in page_text.replace("\r", "").split("\n") if ln.strip()]
-    room_pattern = re.compile(rf"\b{re.escape(room_label)}\b", re.IGNORECASE)
-    for i, line in enumerate(lines):
-        if room_pattern.search(line):
-            same_line = re.sub(room_pattern.pattern, "", line, flags=re.IGNORECASE).strip(" :-–")
-            if same_line:
-                return same_line[:120]
-            if i + 1 < len(lines):
-                return lines[i + 1][:120]
-    return None
 
+    __slots__ = ("stamp", "chats", "sources", "rooms", "enabled", "watched")
 
-def set_watch(state, enabled: bool, room: str | None = None):
-    state["enabled"] = enabled
-    if room is not None:
-        state["room"] = room
-        state["last_value"] = None
-        state["current_value"] = None
+    def __init__(self, state, stamp=None):
+        entries = list(iter_subs(state))
+        self.stamp = stamp
+        self.chats = tuple(sys.intern(chat) for chat, _, _ in entries)
+        self.sources = tuple(sys.intern(sid) for _, sid, _ in entries)
+        self.rooms = tuple(sys.intern(sub["room"]) if sub.get("room") else None for _, _, sub in entries)
+        self.enabled = bytearray(bool(sub.get("enabled")) for _, _, sub in entries)
+        watched = {src.id: set(src.rooms) for src in SOURCES.values() if src.rooms}
+        for sid, room, on in zip(self.sources, self.rooms, self.enabled):
+            if on and room and sid in SOURCES:
+                watched.setdefault(sid, set()).add(room)
+        self.watched = {sid: room_tuple(sorted(rooms)) for sid, rooms in watched.items()}
 
-    if enabled and state.get("room"):
-        log_event(f"Monitoring STARTED for {state['room']}")
-        send_telegram(f"✅ Monitoring STARTED for {state['room']}")
-    elif not enabled:
-        log_event("Monitoring STOPPED")
-        send_telegram("🛑 Monitoring STOPPED")
+    def __len__(self):
+        return len(self.chats)
 
+    def subs_on(self, source_id: str, rooms):
+        """(chat, room) for each enabled subscription on a source whose room is in `rooms`."""
+        for chat, sid, room, on in zip(self.chats, self.sources, self.rooms, self.enabled):
+            if on and sid == source_id and room in rooms:
+                yield chat, room
 
-def login_required(fn):
-    @wraps(fn)
-    def wrapper(*args, **kwargs):
-        if not session.get("logged_in"):
-            return redirect(url_for("login", next=request.path))
-        return fn(*args, **kwargs)
-    return wrapper
 
+_SUB_INDEX = [None]
 
-THEME_JS = r"""
-<script>
-(function(){
-  // Theme modes:
-  // - "system": follow OS preference and auto-sync on changes
-  // - "light"/"dark": manual override
-  const KEY = "ct_theme_mode"; // "system" | "light" | "dark"
-  const root = document.documentElement;
-  const mq = window.matchMedia && window.matchMedia("(prefers-color-scheme: light)");
 
-  function apply(mode){
-    if(mode === "light"){
-      root.classList.add("light");
-    } else if(mode === "dark"){
-      root.classList.remove("light");
-    } else {
-      const prefersLight = mq && mq.matches;
-      if(prefersLight) root.classList.add("light");
-      else root.classList.remove("light");
-    }
-  }
+def sub_index() -> SubIndex:
+    """The SubIndex for the current state file, rebuilt only when the file changes."""
+    try:
+        st = os.stat(STATE_PATH)
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+    except OSError:
+        stamp = None
+    index = _SUB_INDEX[0]
+    if index is None or stamp is None or index.stamp != stamp:
+        index = _SUB_INDEX[0] = SubIndex(load_state(), stamp)
+    return index
 
-  // Load saved mode, default to system
-  let mode = localStorage.getItem(KEY) || "system";
-  apply(mode);
 
-  // Auto sync if system mode
-  const onChange = () => {
+def save_state(state, previous: str | None = None):
+    """
+    Atomically replace the state file. Skipped when the JSON equals
+    `previous` (the text it was loaded from): an untouched file keeps its
+    stamp, so sub_index() stays cached across polls that change nothing.
+    """
+    text = json.dumps(state, ensure_ascii=False, indent=2)
+    if text == previous:
+        return
+    os.makedirs(os.path.dirname(STATE_PATH), exist_ok=True)
+    tmp = f"{STATE_PATH}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, STATE_PATH)
+
+
+@contextmanager
+def edit_state():
+    """
+    Read-modify-write of the state file under an exclusive flock, so the
+    watcher and any number of web workers/processes never clobber each other.
+    Nothing in the block may touch the network: replies are only queued on the
+    outbox, and fetches happen before the lock is taken.
+    """
+    os.makedirs(os.path.dirname(STATE_PATH), exist_ok=True)
+    with open(f"{STATE_PATH}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            try:
+                with open(STATE_PATH, "r", encoding="utf-8") as f:
+                    text = f.read()
+            except OSError:
+                text = None
+            state = load_state(text)
+            yield state
+            save_state(state, text)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def host_budget(host: str):
+    budget = HOST_BUDGETS.get(host, ())
+    return (budget + (FETCH_RATE, FETCH_BURST)[len(budget):])[:2]
+
+
+def take_token(key: str, rate: float, burst: float) -> bool:
+    """
+    Take one token from a bucket in the store. Updated under BEGIN IMMEDIATE,
+    so a bucket holds across threads, processes and replicas on the same volume.
+    """
+    now = time.time()
+    conn = db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT tokens, updated_at FROM host_buckets WHERE host = ?", (key,)).fetchone()
+        tokens = burst if row is None else min(burst, row[0] + max(0.0, now - row[1]) * rate)
+        ok = tokens >= 1
+        conn.execute(
+            "INSERT INTO host_buckets (host, tokens, updated_at, denied) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (host) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at, "
+            "denied = denied + excluded.denied",
+            (key, tokens - 1 if ok else tokens, now, 0 if ok else 1),
+        )
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return ok
+
+
+def acquire_fetch(url: str):
+    """Take one request from the host's token bucket, or raise OverBudget."""
+    host = urlsplit(url).hostname or url
+    if not take_token(host, *host_budget(host)):
+        raise OverBudget(f"budget:{host}")
+
+
+def budget_rows():
+    now = time.time()
+    rows = []
+    for host, tokens, updated_at, denied in db().execute(
+        "SELECT host, tokens, updated_at, denied FROM host_buckets WHERE host NOT LIKE 'notify:%' ORDER BY host"
+    ):
+        rate, burst = host_budget(host)
+        rows.append({"host": host, "rate": rate, "burst": burst, "denied": denied,
+                     "tokens": round(min(burst, tokens + max(0.0, now - updated_at) * rate), 2)})
+    return rows
+
+
+def fetch_page_bytes(url: str):
+    acquire_fetch(url)
+    r = requests.get(url, timeout=TIMEOUT, headers={"Cache-Control": "no-cache"})
+    r.raise_for_status()
+    return r.content, r.encoding
+
+
+def html_to_text(content, encoding: str | None = None) -> str:
+    from bs4 import BeautifulSoup  # heavy; kept off the startup path
+
+    if isinstance(content, bytes):
+        soup = BeautifulSoup(content, "html.parser", from_encoding=encoding)
+    else:
+        soup = BeautifulSoup(content, "html.parser")
+    return soup.get_text("\n")
+
+
+class TextLines(HTMLParser):
+    """
+    The stripped, non-empty text lines of a page, as html_to_text would
+    split them (script/style skipped), without building a document tree.
+
+    When fed in chunks, HTMLParser hands over a text node in pieces, cut
+    wherever a chunk ends. Text is therefore buffered and only turned into
+    lines at a tag, a comment, close(), or a newline (everything before it
+    is complete; the parser already holds back a half-read "&...;").
+    """
+
+    SKIP = ("script", "style")
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.lines = []
+        self.skip = 0
+        self.text = []
+
+    def handle_starttag(self, tag, attrs):
+        self.flush()
+        if tag in self.SKIP:
+            self.skip += 1
+
+    def handle_endtag(self, tag):
+        self.flush()
+        if tag in self.SKIP and self.skip:
+            self.skip -= 1
+
+    def handle_comment(self, data):
+        self.flush()
+
+    def handle_data(self, data):
+        if self.skip:
+            return
+        self.text.append(data)
+        if "\n" in data:
+            done, _, rest = "".join(self.text).rpartition("\n")
+            self.text = [rest] if rest else []
+            self.emit(done)
+
+    def close(self):
+        super().close()
+        self.flush()
+
+    def flush(self):
+        if self.text:
+            text, self.text = "".join(self.text), []
+            self.emit(text)
+
+    def emit(self, text: str):
+        for ln in text.replace("\r", "").split("\n"):
+            ln = ln.strip()
+            if ln:
+                self.line(ln)
+
+    def line(self, ln: str):
+        self.lines.append(ln)
+
+
+def html_lines(content, encoding: str | None = None) -> list:
+    parser = TextLines()
+    parser.feed(content.decode(encoding or "utf-8", "replace") if isinstance(content, bytes) else content)
+    parser.close()
+    return parser.lines
+
+
+def parse_board(content, encoding, rooms, labels: bool = False):
+    """
+    Raw page -> {room: value} for the requested rooms. Runs in pool workers, so
+    keep it picklable. With labels=True returns (values, {room key: label}) for
+    every label on the page, from the same pass.
+    """
+    lines = html_lines(content, encoding)
+    index = room_index(lines)
+    values = {}
+    for room in rooms:
+        hit = index.get(room_key(room))
+        # labels outside ROOM_LABEL_PATTERN (e.g. "Dental OPD") still use the exact search, on the same lines
+        values[sys.intern(room)] = hit[1] if hit else find_room_value(lines, room)
+    if labels:
+        return values, {key: label for key, (label, _) in index.items()}
+    return values
+
+
+class StaleParse(Exception):
+    """A newer fetch for the same page superseded this parse."""
+
+
+class ParsePool:
+    """
+    Bounded process pool for page parsers. At most `queue` parses are queued or
+    running; submitting a newer page for the same key cancels the older one
+    (or discards its result if it already started).
+    """
+
+    def __init__(self, workers: int, queue: int):
+        self.executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+        self.slots = threading.BoundedSemaphore(max(1, queue))
+        self.latest = {}
+        self.lock = threading.Lock()
+
+    def submit(self, key, fn, content, encoding, rooms):
+        with self.lock:
+            prev = self.latest.pop(key, None)
+        if prev is not None:
+            prev.cancel()
+        if not self.slots.acquire(timeout=TIMEOUT):
+            raise RuntimeError("parse queue full")
+        try:
+            fut = self.executor.submit(fn, content, encoding, tuple(rooms))
+        except Exception:
+            self.slots.release()
+            raise
+        fut.add_done_callback(lambda _: self.slots.release())
+        with self.lock:
+            self.latest[key] = fut
+        return fut
+
+    def parse(self, key, fn, content, encoding, rooms) -> dict:
+        fut = self.submit(key, fn, content, encoding, rooms)
+        try:
+            result = fut.result(timeout=TIMEOUT)
+        except CancelledError:
+            raise StaleParse(key)
+        except FutureTimeout:
+            fut.cancel()
+            raise
+        with self.lock:
+            if self.latest.get(key) is not fut:
+                raise StaleParse(key)
+            del self.latest[key]
+        return result
+
+
+PARSE_POOL = None
+
+
+def parse_pool():
+    global PARSE_POOL
+    if PARSE_POOL is None and PARSE_WORKERS > 0:
+        PARSE_POOL = ParsePool(PARSE_WORKERS, PARSE_QUEUE)
+    return PARSE_POOL
+
+
+# Parser profiles: name -> picklable (content, encoding, rooms) -> {room: value}
+# (or (values, {room key: label}) when called with labels=True)
+PARSERS = {
+    "lines": parse_board,
+    # same extraction, but read straight from learned anchors while the layout is unchanged
+    "anchored": parse_board,
+    # fetched incrementally and cut off once every watched room is found
+    "stream": parse_board,
+}
+
+
+@dataclass
+class Source:
+    id: str
+    url: str
+    name: str = ""
+    parser: str = "lines"
+    poll_seconds: int = 0  # 0: follow POLL_SECONDS
+    concurrency: int = 1
+    rooms: list = field(default_factory=list)  # always extracted, for /api/board
+    value_pattern: str = ""  # what a room's value looks like; defaults to VALUE_PATTERN
+    slots: threading.BoundedSemaphore = field(default=None, repr=False, compare=False)
+
+    @property
+    def interval(self) -> float:
+        return self.poll_seconds or POLL_SECONDS
+
+    def __post_init__(self):
+        if self.parser not in PARSERS:
+            raise ValueError(f"source {self.id}: unknown parser {self.parser!r}")
+        self.name = self.name or self.id
+        self.slots = threading.BoundedSemaphore(max(1, int(self.concurrency)))
+
+
+def load_sources() -> dict:
+    raw = SOURCES_JSON
+    if not raw and SOURCES_PATH:
+        with open(SOURCES_PATH, "r", encoding="utf-8") as f:
+            raw = f.read()
+    entries = json.loads(raw) if raw else [{"id": DEFAULT_SOURCE, "url": URL, "name": "CareTrust"}]
+    keys = Source.__dataclass_fields__.keys() - {"slots"}
+    sources = {}
+    for e in entries:
+        src = Source(**{k: v for k, v in e.items() if k in keys})
+        sources[src.id] = src
+    return sources
+
+
+SOURCES = load_sources()
+SETTINGS = Settings()
+
+
+def default_source_id() -> str:
+    return DEFAULT_SOURCE if DEFAULT_SOURCE in SOURCES else next(iter(SOURCES))
+
+
+_DIGITS = re.compile(r"\d+")
+
+
+def layout_fingerprint(page: str) -> str:
+    # Token numbers change, the markup around them does not
+    return hashlib.blake2b(_DIGITS.sub("", page).encode("utf-8", "replace"), digest_size=12).hexdigest()
+
+
+class LayoutAnchors:
+    """
+    Where each room's value sits in one source's raw HTML.
+
+    anchors[room] is the exact markup from the room label up to its value;
+    the value runs from there to the next "<". Anchors are only trusted while
+    the page's layout fingerprint matches the one they were learned on.
+    """
+
+    __slots__ = ("fingerprint", "anchors", "lock", "hits", "misses")
+
+    def __init__(self):
+        self.fingerprint = None
+        self.anchors = {}
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def read(page: str, prefix: str):
+        i = page.find(prefix)
+        if i < 0:
+            return None
+        j = i + len(prefix)
+        k = page.find("<", j)
+        if k < 0:
+            return None
+        value = html.unescape(page[j:k]).strip()
+        return value[:120] or None
+
+    def lookup(self, page: str, fingerprint: str, rooms):
+        with self.lock:
+            if fingerprint != self.fingerprint or any(r not in self.anchors for r in rooms):
+                self.misses += 1
+                return None
+            values = {r: self.read(page, self.anchors[r]) for r in rooms}
+            if any(v is None for v in values.values()):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return values
+
+    def learn(self, page: str, fingerprint: str, values: dict) -> int:
+        learned = {}
+        for room, value in values.items():
+            if not value:
+                continue
+            for m in re.finditer(rf"\b{re.escape(room)}\b", page, re.IGNORECASE):
+                v = page.find(html.escape(value, quote=False), m.end(), m.end() + 2000)
+                if v < 0:
+                    continue
+                prefix = page[m.start():v]
+                # must resolve back to this exact spot and value
+                if page.find(prefix) == m.start() and self.read(page, prefix) == value:
+                    learned[room] = prefix
+                break
+        with self.lock:
+            if fingerprint != self.fingerprint:
+                self.fingerprint, self.anchors = fingerprint, {}
+            self.anchors.update(learned)
+        return len(learned)
+
+
+ANCHORS = {}
+
+
+def parse_page(src: Source, content, encoding, rooms) -> dict:
+    """
+    Full parse with the source's parser, offloaded when a pool is configured.
+    The room-label catalogue is refreshed from the same parse.
+    """
+    global PARSE_POOL
+    fn = partial(PARSERS[src.parser], labels=True)
+    pool = parse_pool()
+    if pool is None:
+        values, labels = fn(content, encoding, rooms)
+    else:
+        try:
+            values, labels = pool.parse(src.id, fn, content, encoding, rooms)
+        except BrokenProcessPool:
+            PARSE_POOL = None  # a worker died; rebuild the pool on the next poll
+            pool.executor.shutdown(wait=False, cancel_futures=True)
+            raise
+    try:
+        record_labels(src.id, labels)
+    except sqlite3.Error as e:
+        log_event(f"Room label index error ({src.id}): {e}", level="error", kind="parser")
+    return values
+
+
+def parse_anchored(src: Source, content, encoding, rooms) -> dict:
+    page = content.decode(encoding or "utf-8", "replace") if isinstance(content, bytes) else content
+    fingerprint = layout_fingerprint(page)
+    cache = ANCHORS.setdefault(src.id, LayoutAnchors())
+
+    values = cache.lookup(page, fingerprint, rooms)
+    if values is not None:
+        return values
+
+    values = parse_page(src, content, encoding, rooms)
+    relayout = cache.fingerprint is not None and cache.fingerprint != fingerprint
+    n = cache.learn(page, fingerprint, values)
+    if relayout:
+        log_event(f"{src.name}: page layout changed, re-learned {n}/{len(rooms)} anchors", kind="parser")
+    return values
+
+
+class RoomStream(TextLines):
+    """
+    Incremental version of parse_board: each room is resolved as soon as its
+    label line, or the line after it, arrives.
+    """
+
+    def __init__(self, rooms):
+        super().__init__()
+        self.rooms = list(rooms)
+        self.keys = {}  # room key -> subscribed spellings, for labels ROOM_LABEL_PATTERN recognizes
+        self.patterns = {}  # everything else is searched for as typed
+        for room in self.rooms:
+            if _ROOM_LABEL.fullmatch(room.strip()):
+                self.keys.setdefault(room_key(room), []).append(room)
+            else:
+                self.patterns[room] = re.compile(rf"\b{re.escape(room)}\b", re.IGNORECASE)
+        self.values = {}
+        self.pending = []
+
+    @property
+    def done(self) -> bool:
+        return len(self.values) == len(self.rooms)
+
+    def line(self, ln: str):
+        for room in self.pending:
+            self.values[room] = ln[:120]
+        self.pending = []
+        for m in _ROOM_LABEL.finditer(ln):
+            same_line = (ln[:m.start()] + ln[m.end():]).strip(" :-–")
+            for room in self.keys.get(room_key(m.group()), ()):
+                if room in self.values or room in self.pending:
+                    continue
+                if same_line:
+                    self.values[room] = same_line[:120]
+                else:
+                    self.pending.append(room)
+        for room, pattern in self.patterns.items():
+            if room in self.values or not pattern.search(ln):
+                continue
+            same_line = pattern.sub("", ln).strip(" :-–")
+            if same_line:
+                self.values[room] = same_line[:120]
+            else:
+                self.pending.append(room)
+
+
+def stream_board(src: Source, rooms) -> dict:
+    """Read the page chunk by chunk and hang up as soon as every room has a value."""
+    parser = RoomStream(rooms)
+    headers = {"Cache-Control": "no-cache", "Accept-Encoding": "gzip, deflate"}
+
+    def open_stream():
+        # budget and status both inside the call: a refused call spends no token, and 5xx counts
+        acquire_fetch(src.url)
+        r = requests.get(src.url, timeout=TIMEOUT, headers=headers, stream=True)
+        try:
+            r.raise_for_status()
+        except requests.HTTPError:
+            r.close()
+            raise
+        return r
+
+    with src.slots, breaker(f"source:{src.id}").call(open_stream) as r:
+        decoder = codecs.getincrementaldecoder(r.encoding or "utf-8")(errors="replace")
+        for chunk in r.iter_content(STREAM_CHUNK):
+            parser.feed(decoder.decode(chunk))
+            if parser.done:
+                break  # leaving the block closes the connection mid-body
+        else:
+            parser.feed(decoder.decode(b"", final=True))
+            parser.close()
+    return {room: parser.values.get(room) for room in rooms}
+
+
+CODECS = {
+    "lzma": (".xz", lambda b: lzma.compress(b, preset=6), lzma.decompress),
+    "zlib": (".z", lambda b: zlib.compress(b, 9), zlib.decompress),
+}
+
+
+def blob_path(sha: str, codec: str) -> str:
+    return os.path.join(ARCHIVE_DIR, sha[:2], sha + CODECS[codec][0])
+
+
+def archive_page(source_id: str, content: bytes, encoding: str | None, now: float | None = None):
+    """
+    Keep each distinct page once (keyed by sha256, compressed). The index
+    gets a row only when a source's page differs from its previous poll.
+    """
+    now = now if now is not None else time.time()
+    sha = hashlib.sha256(content).hexdigest()
+    conn = db()
+    prev = conn.execute(
+        "SELECT sha FROM archive WHERE source = ? ORDER BY id DESC LIMIT 1", (source_id,)
+    ).fetchone()
+    if conn.execute("UPDATE archive_blobs SET last_seen = ? WHERE sha = ?", (now, sha)).rowcount == 0:
+        codec = ARCHIVE_CODEC if ARCHIVE_CODEC in CODECS else "lzma"
+        data = CODECS[codec][1](content)
+        path = blob_path(sha, codec)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(data)
+        os.replace(f"{path}.tmp", path)
+        conn.execute(
+            "INSERT OR REPLACE INTO archive_blobs VALUES (?, ?, ?, ?, ?, ?)",
+            (sha, codec, len(content), len(data), now, now),
+        )
+        prune_archive(keep=sha)
+    if not prev or prev[0] != sha:
+        conn.execute(
+            "INSERT INTO archive (ts, source, sha, encoding) VALUES (?, ?, ?, ?)", (now, source_id, sha, encoding)
+        )
+    return sha
+
+
+def prune_archive(keep: str | None = None):
+    """Drop the least recently seen pages until the archive fits ARCHIVE_MAX_MB, never `keep`."""
+    conn = db()
+    total = conn.execute("SELECT COALESCE(SUM(stored_bytes), 0) FROM archive_blobs").fetchone()[0]
+    budget = ARCHIVE_MAX_MB * 1024 * 1024
+    while total > budget:
+        row = conn.execute(
+            "SELECT sha, codec, stored_bytes FROM archive_blobs WHERE sha != ? ORDER BY last_seen LIMIT 1", (keep or "",)
+        ).fetchone()
+        if not row:
+            break
+        sha, codec, size = row
+        try:
+            os.remove(blob_path(sha, codec))
+        except FileNotFoundError:
+            pass
+        conn.execute("DELETE FROM archive_blobs WHERE sha = ?", (sha,))
+        conn.execute("DELETE FROM archive WHERE sha = ?", (sha,))
+        total -= size
+
+
+def archive_get(sha: str):
+    """Raw page bytes for a hash, or None if it was never stored / already pruned."""
+    row = db().execute("SELECT codec FROM archive_blobs WHERE sha = ?", (sha,)).fetchone()
+    if not row:
+        return None
+    try:
+        with open(blob_path(sha, row[0]), "rb") as f:
+            return CODECS[row[0]][2](f.read())
+    except FileNotFoundError:
+        return None
+
+
+def archive_index(source_id=None, since=None, until=None, limit=None):
+    """[(id, ts, source, sha, encoding)] oldest first."""
+    sql, args = "SELECT id, ts, source, sha, encoding FROM archive WHERE 1=1", []
+    for cond, val in (("source = ?", source_id), ("ts >= ?", since), ("ts < ?", until)):
+        if val is not None:
+            sql += f" AND {cond}"
+            args.append(val)
+    sql += " ORDER BY id"
+    if limit:
+        sql += " LIMIT ?"
+        args.append(limit)
+    return db().execute(sql, args).fetchall()
+
+
+def read_board(src: Source, rooms) -> dict:
+    """Fetch a source and extract the given rooms."""
+    if src.parser == "stream":
+        return stream_board(src, rooms)
+    with src.slots:
+        content, encoding = breaker(f"source:{src.id}").call(fetch_page_bytes, src.url)
+    if ARCHIVE_DIR:
+        try:
+            archive_page(src.id, content, encoding)
+        except Exception as e:
+            log_event(f"Archive error ({src.id}): {e}", level="error", kind="archive")
+    if src.parser == "anchored":
+        return parse_anchored(src, content, encoding, rooms)
+    return parse_page(src, content, encoding, rooms)
+
+
+def match_rate(src: Source, rooms, values: dict) -> float:
+    """
+    Share of the rooms found on the page whose value looks like a token. A
+    room that isn't on the page at all is usually a mistyped subscription
+    or a closed room, so it doesn't count. When none can be found, the page
+    only counts as broken if it should have had them: a room the source
+    always extracts is missing, or the last parse found no room labels at all.
+    """
+    found = [values[r] for r in rooms if values.get(r) is not None]
+    if not rooms:
+        return 1.0
+    if not found:
+        broken = bool(set(src.rooms) & set(rooms)) or _KNOWN_LABELS.get(src.id) == {}
+        return 0.0 if broken else 1.0
+    pattern = src.value_pattern or VALUE_PATTERN
+    return sum(1 for v in found if re.fullmatch(pattern, v.strip(), re.IGNORECASE)) / len(found)
+
+
+class ParseCheck:
+    """
+    Self-check of extracted values, per source. A markup change makes the
+    line heuristic return text that differs on every poll, which would alert
+    on every poll. A board where fewer than SELFCHECK_MIN_RATE of the rooms
+    look like tokens is held back (not published, no alerts). After
+    SELFCHECK_POLLS such polls in a row the source is quarantined and admins
+    are told once; as many healthy polls in a row lift it again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sources = {}  # source_id -> {"quarantined", "streak", "rate", "since"}
+
+    def check(self, src: Source, rooms, values: dict):
+        """Returns (apply, notices) where notices are (chat, text, priority) for admins."""
+        rate = match_rate(src, rooms, values)
+        healthy = rate >= SELFCHECK_MIN_RATE
+        with self.lock:
+            st = self.sources.setdefault(src.id, {"quarantined": False, "streak": 0, "rate": 1.0, "since": None})
+            st["rate"] = round(rate, 3)
+            # streak counts polls that disagree with the current status
+            st["streak"] = st["streak"] + 1 if healthy == st["quarantined"] else 0
+            flipped = st["streak"] >= SELFCHECK_POLLS
+            if flipped:
+                st["quarantined"], st["streak"], st["since"] = not st["quarantined"], 0, CLOCK.time()
+            quarantined = st["quarantined"]
+
+        name, pct = src.name, f"{rate:.0%}"
+        if not flipped:
+            if not healthy and not quarantined:
+                log_event(f"Self-check: {pct} of rooms look valid on {name}; board held back",
+                          level="warning", kind="selfcheck")
+            return healthy and not quarantined, []
+        if quarantined:
+            sample = "; ".join(f"{r}: {(values.get(r) or '—')[:40]}" for r in list(rooms)[:3])
+            text = (f"⚠️ {name} page structure looks changed: only {pct} of rooms parse as tokens.\n"
+                    f"Alerts for {name} are paused until it recovers.\n{sample}")
+            log_event(f"Self-check: {name} quarantined ({pct} valid)", level="error", kind="selfcheck")
+        else:
+            text = f"✅ {name} parses normally again ({pct} valid); alerts resumed."
+            log_event(f"Self-check: {name} recovered ({pct} valid)", kind="selfcheck")
+        return healthy and not quarantined, [(chat, text, URGENT) for chat in ADMIN_CHATS]
+
+    def snapshot(self):
+        with self.lock:
+            return {sid: dict(st) for sid, st in self.sources.items()}
+
+    def load(self, sources: dict):
+        with self.lock:
+            self.sources.update(sources)
+
+
+SELFCHECK = ParseCheck()
+
+
+_ROOM_TUPLES = {}
+
+
+def room_tuple(rooms) -> tuple:
+    """Interned, shared tuple of room labels: every snapshot of the same room set reuses one."""
+    t = tuple(sys.intern(r) for r in rooms)
+    if len(_ROOM_TUPLES) > 256:
+        _ROOM_TUPLES.clear()
+    return _ROOM_TUPLES.setdefault(t, t)
+
+
+class Snapshot:
+    """
+    One published board. Values are a tuple aligned with a shared tuple of
+    interned room labels instead of a dict per snapshot. Indexable like the
+    dict it replaced (snap["version"], snap["values"]).
+    """
+
+    __slots__ = ("source", "version", "fetched_at", "changed_at", "rooms", "cells", "etag", "_body")
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    @property
+    def values(self) -> dict:
+        """A new dict on every access; loops over the board should use rooms/cells."""
+        return dict(zip(self.rooms, self.cells))
+
+    @property
+    def body(self) -> str:
+        """The /api/board JSON, serialised on first read and kept (the watcher never reads it)."""
+        if self._body is None:
+            self._body = json.dumps({"source": self.source, "version": self.version, "fetched_at": self.fetched_at,
+                                     "changed_at": self.changed_at, "values": self.values}, ensure_ascii=False)
+        return self._body
+
+    def same_values(self, values: dict) -> bool:
+        return len(values) == len(self.rooms) and all(
+            r in values and values[r] == v for r, v in zip(self.rooms, self.cells)
+        )
+
+
+class Board:
+    """
+    Latest room->value snapshot per source, served by /api/board.
+
+    The version only moves when the values change. Snapshots are written
+    through to the SQLite store so web workers in another process see them,
+    and each one carries its ETag and, once first served, its JSON body, so
+    repeated reads are just a dict lookup.
+    """
+
+    REFRESH = 0.5  # how often a process without the watcher re-reads the store
+
+    def __init__(self):
+        self.snaps = {}
+        self.read_at = {}
+        self.cond = threading.Condition()
+
+    @staticmethod
+    def make(source_id, version, fetched_at, changed_at, values):
+        snap = Snapshot()
+        snap.source, snap.version, snap.fetched_at, snap.changed_at = source_id, version, fetched_at, changed_at
+        snap.rooms, snap.cells = room_tuple(values), tuple(values.values())
+        snap.etag, snap._body = f"{source_id}-{version}", None
+        return snap
+
+    def load(self, source_id):
+        row = db().execute(
+            'SELECT version, fetched_at, changed_at, "values" FROM board WHERE source = ?', (source_id,)
+        ).fetchone()
+        self.read_at[source_id] = time.monotonic()
+        if row:
+            return self.make(source_id, row[0], row[1], row[2], json.loads(row[3]))
+        return None
+
+    def publish(self, source_id: str, values: dict, now: float | None = None):
+        now = now if now is not None else CLOCK.time()
+        with self.cond:
+            prev = self.snaps.get(source_id) or self.load(source_id)
+            if prev and prev.same_values(values):
+                snap = self.make(source_id, prev.version, now, prev.changed_at, values)
+            else:
+                snap = self.make(source_id, (prev.version if prev else 0) + 1, now, now, values)
+            db().execute(
+                'INSERT OR REPLACE INTO board (source, version, fetched_at, changed_at, "values") VALUES (?, ?, ?, ?, ?)',
+                (source_id, snap.version, now, snap.changed_at, json.dumps(values, ensure_ascii=False)),
+            )
+            self.snaps[source_id] = snap
+            self.cond.notify_all()
+        return snap
+
+    def seed(self, rows):
+        """Restore snapshots from a checkpoint: {source: [version, fetched_at, changed_at, rooms, cells]}."""
+        with self.cond:
+            for source_id, (version, fetched_at, changed_at, *board) in rows.items():
+                # older checkpoints have a {room: value} dict instead of rooms, cells
+                values = board[0] if len(board) == 1 else dict(zip(*board))
+                if source_id not in self.snaps:
+                    self.snaps[source_id] = self.make(source_id, version, fetched_at, changed_at, values)
+                    self.read_at[source_id] = time.monotonic()
+
+    def get(self, source_id: str):
+        snap = self.snaps.get(source_id)
+        if WATCHER_MODE == "process" and time.monotonic() - self.read_at.get(source_id, 0) > self.REFRESH:
+            snap = self.load(source_id) or snap
+            if snap:
+                self.snaps[source_id] = snap
+        elif snap is None and source_id not in self.read_at:
+            snap = self.load(source_id)
+            if snap:
+                self.snaps[source_id] = snap
+        return snap
+
+    def wait(self, source_id: str, since: int, timeout: float):
+        """Block until the version exceeds `since` (or timeout); returns the latest snapshot."""
+        return self.wait_for(source_id, lambda snap: snap["version"] > since, timeout)
+
+    def wait_for(self, source_id: str, ready, timeout: float):
+        deadline = time.monotonic() + timeout
+        while True:
+            snap = self.get(source_id)
+            left = deadline - time.monotonic()
+            if (snap and ready(snap)) or left <= 0:
+                return snap
+            with self.cond:
+                self.cond.wait(min(left, self.REFRESH) if WATCHER_MODE == "process" else left)
+
+
+BOARD = Board()
+# Long polls park a request thread; past this many the rest are answered right away
+LONG_POLLS = threading.BoundedSemaphore(max(1, BOARD_WAITERS))
+
+
+class SingleFlight:
+    """Concurrent do(key, fn) calls share one execution of fn and its result (or error)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {"done": threading.Event()}
+        if not leader:
+            call["done"].wait()
+            if "error" in call:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call["done"].set()
+
+
+FLIGHTS = SingleFlight()
+
+
+def extract_room_value(page_text: str, room_label: str):
+    """
+    Heuristic: find the line containing "Room 09" and return:
+      - value on same line (after the label), else
+      - next non-empty line
+    """
+    return find_room_value(page_lines(page_text), room_label)
+
+
+def find_room_value(lines: list, room_label: str):
+    """extract_room_value over lines that are already split and stripped."""
+    room_pattern = re.compile(rf"\b{re.escape(room_label)}\b", re.IGNORECASE)
+    for i, line in enumerate(lines):
+        if room_pattern.search(line):
+            same_line = re.sub(room_pattern.pattern, "", line, flags=re.IGNORECASE).strip(" :-–")
+            if same_line:
+                return same_line[:120]
+            if i + 1 < len(lines):
+                return lines[i + 1][:120]
+    return None
+
+
+def page_lines(page_text: str) -> list:
+    return [ln.strip() for ln in page_text.replace("\r", "").split("\n") if ln.strip()]
+
+
+def room_key(label: str) -> str:
+    """Normalized room label: "Room 9", "room09" and "RM 09" all give "room9"."""
+    parts = re.findall(r"[a-z]+|\d+", label.lower())
+    return "".join(str(int(p)) if p.isdigit() else ROOM_ALIASES.get(p, p) for p in parts)
+
+
+_ROOM_LABEL = re.compile(ROOM_LABEL_PATTERN, re.IGNORECASE)
+
+
+def room_index(lines) -> dict:
+    """
+    One pass over a page: room key -> (label as printed, value), with the same
+    rule as extract_room_value (rest of the line, else the next line). The
+    first occurrence of a room wins.
+    """
+    index = {}
+    for i, line in enumerate(lines):
+        for m in _ROOM_LABEL.finditer(line):
+            key = room_key(m.group())
+            if key in index:
+                continue
+            same_line = (line[:m.start()] + line[m.end():]).strip(" :-–")
+            if same_line:
+                index[key] = (m.group(), same_line[:120])
+            elif i + 1 < len(lines):
+                index[key] = (m.group(), lines[i + 1][:120])
+    return index
+
+
+_KNOWN_LABELS = {}  # source_id -> {room key: label} last written to room_labels
+
+
+def record_labels(source_id: str, labels: dict):
+    """Store a source's room labels (for suggestions); a no-op while they stay the same."""
+    if _KNOWN_LABELS.get(source_id) == labels:
+        return
+    now = CLOCK.time()
+    db().executemany(
+        "INSERT OR REPLACE INTO room_labels (source, key, label, seen_at) VALUES (?, ?, ?, ?)",
+        [(source_id, key, label, now) for key, label in labels.items()],
+    )
+    _KNOWN_LABELS[source_id] = labels
+
+
+def suggest_rooms(source_id: str, query: str, limit: int = 5) -> list:
+    """Closest known room labels for what a user typed, best first."""
+    labels = {key: label for key, label in db().execute(
+        "SELECT key, label FROM room_labels WHERE source = ?", (source_id,)
+    )}
+    src = SOURCES.get(source_id)
+    for room in (src.rooms if src else []):
+        labels.setdefault(room_key(room), room)
+    q = room_key(query)
+    if not q:
+        return sorted(labels.values(), key=lambda lb: (room_key(lb), lb))[:limit]
+    scored = []
+    for key, label in labels.items():
+        if key == q:
+            score = 2.0
+        elif key.startswith(q):
+            score = 1.0 + len(q) / len(key)
+        else:
+            score = difflib.SequenceMatcher(None, q, key).ratio()
+        if score >= 0.6:
+            scored.append((-score, key, label))
+    return [label for _, _, label in sorted(scored)[:limit]]
+
+
+def resolve_room(source_id: str, room: str):
+    """(label to store, suggestions): the page's own spelling if the room is known, else hints."""
+    row = db().execute(
+        "SELECT label FROM room_labels WHERE source = ? AND key = ?", (source_id, room_key(room))
+    ).fetchone()
+    if row:
+        return row[0], []
+    return room, suggest_rooms(source_id, room, 3)
+
+
+def source_label(source_id: str) -> str:
+    # Only mention the source when there is more than one
+    if len(SOURCES) < 2:
+        return ""
+    src = SOURCES.get(source_id)
+    return f" @ {src.name if src else source_id}"
+
+
+def set_watch(state, enabled: bool, room: str | None = None, chat=None, source_id=None):
+    chat = str(chat or DASH_CHAT)
+    source_id = source_id or default_source_id()
+    sub = get_sub(state, chat, source_id)
+    sub["enabled"] = enabled
+    if room is not None:
+        sub["room"] = room
+        sub["last_value"] = None
+        sub["current_value"] = None
+        sub["alert_fired"] = False
+
+    where = source_label(source_id)
+    if enabled and sub.get("room"):
+        log_event(f"Monitoring STARTED for {sub['room']}{where}", room=sub["room"], kind="watch")
+        reply(f"✅ Monitoring STARTED for {sub['room']}{where}", chat)
+    elif not enabled:
+        log_event(f"Monitoring STOPPED{where}", room=sub.get("room"), kind="watch")
+        reply(f"🛑 Monitoring STOPPED{where}", chat)
+
+
+def sample_stacks(seconds: float, interval: float):
+    """
+    Poor man's sampling profiler: snapshot every thread's stack via
+    sys._current_frames() and count identical stacks.
+    Returns {"thread;outer;...;inner": samples}.
+    """
+    me = threading.get_ident()
+    counts = {}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)).replace(";", ":"))
+            key = ";".join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        time.sleep(interval)
+    return counts
+
+
+def request_capture(seconds: float, interval: float) -> int:
+    """Ask the watcher process for a capture of its own threads; returns the capture id."""
+    cur = db().execute(
+        "INSERT INTO profile_captures (requested_at, seconds, interval) VALUES (?, ?, ?)", (time.time(), seconds, interval)
+    )
+    return cur.lastrowid
+
+
+def start_captures():
+    """Watcher side: sample for every pending request on a thread of its own and store the counts."""
+    conn = db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute(
+            "SELECT id, seconds, interval FROM profile_captures WHERE started_at IS NULL AND requested_at >= ?",
+            (time.time() - 60,),
+        ).fetchall()
+        conn.execute("UPDATE profile_captures SET started_at = ? WHERE started_at IS NULL", (time.time(),))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+    def capture(capture_id, seconds, interval):
+        counts = sample_stacks(seconds, interval)
+        db().execute("UPDATE profile_captures SET counts = ? WHERE id = ?", (json.dumps(counts), capture_id))
+
+    for row in rows:
+        threading.Thread(target=capture, args=row, name="profile-capture", daemon=True).start()
+
+
+def wait_capture(capture_id: int, timeout: float):
+    """The watcher's counts for a capture, or None if it didn't answer in time."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        row = db().execute("SELECT counts FROM profile_captures WHERE id = ?", (capture_id,)).fetchone()
+        if row and row[0] is not None:
+            db().execute("DELETE FROM profile_captures WHERE id = ? OR requested_at < ?", (capture_id, time.time() - 3600))
+            return json.loads(row[0])
+        time.sleep(0.2)
+    return None
+
+
+def collapsed_stacks(counts) -> str:
+    # Brendan Gregg's collapsed format, ready for flamegraph.pl / speedscope
+    return "".join(f"{k} {v}\n" for k, v in sorted(counts.items()))
+
+
+def login_required(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not session.get("logged_in"):
+            return redirect(url_for("login", next=request.path))
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+THEME_JS = r"""
+<script>
+(function(){
+  // Theme modes:
+  // - "system": follow OS preference and auto-sync on changes
+  // - "light"/"dark": manual override
+  const KEY = "ct_theme_mode"; // "system" | "light" | "dark"
+  const root = document.documentElement;
+  const mq = window.matchMedia && window.matchMedia("(prefers-color-scheme: light)");
+
+  function apply(mode){
+    if(mode === "light"){
+      root.classList.add("light");
+    } else if(mode === "dark"){
+      root.classList.remove("light");
+    } else {
+      const prefersLight = mq && mq.matches;
+      if(prefersLight) root.classList.add("light");
+      else root.classList.remove("light");
+    }
+  }
+
+  // Load saved mode, default to system
+  let mode = localStorage.getItem(KEY) || "system";
+  apply(mode);
+
+  // Auto sync if system mode
+  const onChange = () => {
     const m = localStorage.getItem(KEY) || "system";
     if(m === "system") apply("system");
   };
@@ -335,76 +2508,358 @@ LANDING_TEMPLATE = r"""
 
   __THEME_JS__
 
-  <script>
-    requestAnimationFrame(() => window.location.replace("/login"));
+  <script>
+    requestAnimationFrame(() => window.location.replace("/login"));
+  </script>
+</body>
+</html>
+"""
+
+LOGIN_TEMPLATE = r"""
+<!doctype html>
+<html>
+<head>
+  <meta charset="utf-8"/>
+  <meta name="viewport" content="width=device-width,initial-scale=1"/>
+  <title>Login - CareTrust Watch</title>
+  __PWA_HEAD__
+  <style>
+    :root{
+      --bg: #0f172a;
+      --panel: #020617;
+      --text: #e5e7eb;
+      --muted: #94a3b8;
+      --border:#1f2937;
+      --field:#0b1220;
+    }
+    .light{
+      --bg:#f6f7f9;
+      --panel:#ffffff;
+      --text:#0f172a;
+      --muted:#475569;
+      --border:#e5e7eb;
+      --field:#ffffff;
+    }
+    body{
+      font-family:system-ui,Segoe UI,Arial;
+      margin:0;min-height:100vh;display:grid;place-items:center;
+      background:var(--bg);color:var(--text);
+    }
+    .card{
+      background:var(--panel);
+      border:1px solid var(--border);
+      border-radius:14px;padding:22px;
+      min-width:320px;max-width:420px;
+      box-shadow:0 10px 30px rgba(0,0,0,.18);
+      width:min(420px, calc(100vw - 36px));
+    }
+    h2{margin:0 0 12px 0}
+    label{display:block;font-size:13px;color:var(--muted);margin:10px 0 6px}
+    input{
+      width:100%;padding:10px 12px;
+      border:1px solid var(--border);
+      border-radius:10px;font-size:16px;
+      background:var(--field);color:var(--text);
+    }
+    button{
+      margin-top:14px;width:100%;
+      padding:10px 12px;border-radius:10px;
+      border:1px solid var(--border);
+      background:#111;color:#fff;font-size:16px;cursor:pointer;
+    }
+    .err{margin-top:10px;color:#b91c1c;font-size:14px}
+    .hint{margin-top:10px;color:var(--muted);font-size:12px;line-height:1.35}
+
+    .toggle{
+      position:fixed;top:14px;right:14px;
+      display:inline-flex;align-items:center;gap:8px;
+      padding:8px 10px;border-radius:12px;
+      border:1px solid var(--border);
+      background:var(--panel);color:var(--text);
+      cursor:pointer;z-index:1000;
+    }
+    .dot{width:10px;height:10px;border-radius:999px;background:var(--text);opacity:.8}
+  </style>
+</head>
+<body>
+  <button class="toggle" id="themeBtn" type="button" aria-label="Toggle theme">
+    <span class="dot"></span>
+    <span id="themeLabel" style="font-size:13px;">System</span>
+  </button>
+
+  <div class="card">
+    <h2>CareTrust Watch</h2>
+    <form method="post">
+      <label>Username</label>
+      <input name="username" autocomplete="username" required />
+      <label>Password</label>
+      <input name="password" type="password" autocomplete="current-password" required />
+      <button type="submit">Sign in</button>
+      {% if error %}<div class="err">{{ error }}</div>{% endif %}
+      <div class="hint">
+        Tip: Click theme button to cycle <b>System → Dark → Light</b>.
+      </div>
+      <div class="hint" id="themeHint">Auto (follows device)</div>
+    </form>
+  </div>
+
+  __THEME_JS__
+</body>
+</html>
+"""
+
+DASH_TEMPLATE = r"""
+<!doctype html>
+<html>
+<head>
+  <meta charset="utf-8"/>
+  <meta name="viewport" content="width=device-width,initial-scale=1"/>
+  <title>CareTrust Watch Dashboard</title>
+  __PWA_HEAD__
+  <style>
+    :root{
+      --bg: #0f172a;
+      --panel: #020617;
+      --text: #e5e7eb;
+      --muted: #94a3b8;
+      --border:#1f2937;
+      --chip:#0b1220;
+    }
+    .light{
+      --bg:#f6f7f9;
+      --panel:#ffffff;
+      --text:#0f172a;
+      --muted:#475569;
+      --border:#e5e7eb;
+      --chip:#f1f5f9;
+    }
+    body{
+      font-family:system-ui,Segoe UI,Arial;
+      margin:24px;max-width:980px;
+      background:var(--bg);color:var(--text);
+    }
+    a{color:var(--text)}
+    .top{display:flex;justify-content:space-between;align-items:center;gap:12px;flex-wrap:wrap}
+    .row{display:flex;gap:16px;flex-wrap:wrap}
+    .card{border:1px solid var(--border);border-radius:12px;padding:16px;flex:1;min-width:280px;background:var(--panel)}
+    .k{color:var(--muted);font-size:12px;text-transform:uppercase;letter-spacing:.04em}
+    .v{font-size:20px;margin-top:4px}
+    input,button,select{font-size:16px;padding:10px 12px;border-radius:10px;border:1px solid var(--border);background:var(--chip);color:var(--text)}
+    table{width:100%;border-collapse:collapse;margin-top:8px;font-size:14px}
+    th,td{text-align:left;padding:6px 8px;border-bottom:1px solid var(--border)}
+    th{color:var(--muted);font-weight:normal;font-size:12px;text-transform:uppercase;letter-spacing:.04em}
+    button{cursor:pointer}
+    .btn{border:1px solid var(--border);background:#111;color:#fff}
+    .btn2{border:1px solid var(--border);background:transparent;color:var(--text)}
+    pre{white-space:pre-wrap;background:var(--chip);border:1px solid var(--border);padding:12px;border-radius:12px;max-height:360px;overflow:auto;color:var(--text)}
+    .hint{color:var(--muted);font-size:13px}
+    .pill{display:inline-flex;gap:8px;align-items:center;padding:8px 10px;border:1px solid var(--border);border-radius:999px;background:var(--chip);font-size:13px;color:var(--text)}
+    code{background:rgba(255,255,255,.06);padding:2px 6px;border-radius:8px;border:1px solid var(--border)}
+
+    .toggle{
+      position:fixed;top:14px;right:14px;
+      display:inline-flex;align-items:center;gap:8px;
+      padding:8px 10px;border-radius:12px;
+      border:1px solid var(--border);
+      background:var(--panel);color:var(--text);
+      cursor:pointer;z-index:1000;
+    }
+    .dot{width:10px;height:10px;border-radius:999px;background:var(--text);opacity:.8}
+    .countdown{font-variant-numeric: tabular-nums;}
+  </style>
+</head>
+<body>
+  <button class="toggle" id="themeBtn" type="button" aria-label="Toggle theme">
+    <span class="dot"></span>
+    <span id="themeLabel" style="font-size:13px;">System</span>
+  </button>
+
+  <div class="top">
+    <div>
+      <h2 style="margin:0">CareTrust Watch Dashboard</h2>
+      <div class="hint">Telegram: <code>/startwatch Room 09</code>, <code>/stopwatch</code>, <code>/status</code>, <code>/live on|off</code>, <code>/digest 5</code>, <code>/alertat 45</code>, <code>/notify email a@b.mv</code>, <code>/sources</code></div>
+      <div class="hint" id="themeHint">Auto (follows device)</div>
+    </div>
+    <div style="display:flex;gap:10px;align-items:center;flex-wrap:wrap">
+      <a class="pill" href="/dashboard/charts">Charts</a>
+      <a class="pill" href="/admin/config">Settings</a>
+      <span class="pill">Session expires in: <span class="countdown" id="sessionCountdown">—</span></span>
+      <a class="pill" href="/logout">Logout</a>
+    </div>
+  </div>
+
+  <div class="card" style="margin-top:16px">
+    <div class="k">Watches</div>
+    {% if watches %}
+    <table>
+      <tr><th>Source</th><th>Chat</th><th>Room</th><th>Status</th><th>Current</th><th>Last alerted</th><th>Alerts to</th></tr>
+      {% for w in watches %}
+      <tr>
+        <td>{{ w.source }}</td>
+        <td>{{ w.chat }}</td>
+        <td>{{ w.room or "—" }}</td>
+        <td>{{ "ON ✅" if w.enabled else "OFF 🛑" }}</td>
+        <td>{{ w.current_value or "—" }}</td>
+        <td>{{ w.last_value or "—" }}</td>
+        <td>{{ w.notify or "chat" }}</td>
+      </tr>
+      {% endfor %}
+    </table>
+    {% else %}
+    <div class="v">—</div>
+    {% endif %}
+  </div>
+
+  <div class="card" style="margin-top:16px">
+    <form method="post" action="/action">
+      <div class="k">Controls</div>
+      <div style="display:flex;gap:10px;flex-wrap:wrap;margin-top:10px;align-items:center">
+        {% if sources|length > 1 %}
+        <select name="source">
+          {% for s in sources %}<option value="{{ s.id }}" {% if s.id == current_source %}selected{% endif %}>{{ s.name }}</option>{% endfor %}
+        </select>
+        {% endif %}
+        <input name="room" id="roomInput" placeholder="Room 09" value="{{ room or '' }}" list="roomOptions" autocomplete="off"/>
+        <datalist id="roomOptions"></datalist>
+        <button class="btn" name="do" value="start">Start</button>
+        <button class="btn2" name="do" value="stop">Stop</button>
+        <button class="btn2" name="do" value="setroom">Set room only</button>
+        <button class="btn2" name="do" value="refresh">Refresh now</button>
+      </div>
+      <p class="hint">Spelling is forgiving: <code>Room 9</code>, <code>room09</code> and <code>RM 09</code> are the same room.</p>
+    </form>
+  </div>
+
+  {% if breakers %}
+  <div class="card" style="margin-top:16px">
+    <div class="k">Upstreams</div>
+    <table>
+      <tr><th>Upstream</th><th>Circuit</th><th>Since</th><th>Last error</th></tr>
+      {% for b in breakers %}
+      <tr>
+        <td>{{ b.name }}</td>
+        <td>{{ {"closed": "OK ✅", "open": "OPEN ⛔", "half-open": "PROBING ⏳"}[b.state] }}</td>
+        <td>{{ b.since }}</td>
+        <td>{{ b.last_error or "—" }}</td>
+      </tr>
+      {% endfor %}
+    </table>
+  </div>
+  {% endif %}
+
+  {% if budgets %}
+  <div class="card" style="margin-top:16px">
+    <div class="k">Request budgets</div>
+    <table>
+      <tr><th>Host</th><th>Rate</th><th>Burst</th><th>Available</th><th>Served from snapshot</th></tr>
+      {% for b in budgets %}
+      <tr><td>{{ b.host }}</td><td>{{ b.rate }}/s</td><td>{{ b.burst }}</td><td>{{ b.tokens }}</td><td>{{ b.denied }}</td></tr>
+      {% endfor %}
+    </table>
+  </div>
+  {% endif %}
+
+  {% if delivery %}
+  <div class="card" style="margin-top:16px">
+    <div class="k">Delivery lag, last hour (seconds)</div>
+    <table>
+      <tr><th>Class</th><th>Sent</th><th>p50</th><th>p90</th><th>p99</th><th>Max</th></tr>
+      {% for d in delivery %}
+      <tr><td>{{ d.priority }}</td><td>{{ d.sent }}</td><td>{{ d.p50 }}</td><td>{{ d.p90 }}</td><td>{{ d.p99 }}</td><td>{{ d.max }}</td></tr>
+      {% endfor %}
+    </table>
+  </div>
+  {% endif %}
+
+  <div class="card" style="margin-top:16px">
+    <div class="k">Event log (latest first)</div>
+    <pre>{{ log_text }}</pre>
+    {% if log_cursor %}<p class="hint">Older events: <a href="/api/events?cursor={{ log_cursor }}">/api/events?cursor={{ log_cursor }}</a></p>{% endif %}
+  </div>
+
+  __THEME_JS__
+
+  <script>
+  (function(){
+    const input = document.getElementById("roomInput");
+    const list = document.getElementById("roomOptions");
+    const select = document.querySelector('select[name="source"]');
+    let timer = null;
+    function suggest(){
+      const source = select ? select.value : "{{ current_source }}";
+      fetch("/api/rooms?source=" + encodeURIComponent(source) + "&q=" + encodeURIComponent(input.value))
+        .then(r => r.ok ? r.json() : {rooms: []})
+        .then(d => {
+          list.innerHTML = "";
+          for(const label of d.rooms){
+            const o = document.createElement("option");
+            o.value = label;
+            list.appendChild(o);
+          }
+        })
+        .catch(() => {});
+    }
+    if(input){
+      input.addEventListener("input", () => { clearTimeout(timer); timer = setTimeout(suggest, 200); });
+      input.addEventListener("focus", suggest, {once: true});
+    }
+  })();
+  </script>
+
+  <script>
+  (function(){
+    const loginAt = Number({{ login_at_ms }}) || 0;
+    const timeoutMs = Number({{ session_timeout_ms }}) || 0;
+    const el = document.getElementById("sessionCountdown");
+
+    function fmt(ms){
+      if(ms <= 0) return "0:00";
+      const s = Math.floor(ms/1000);
+      const m = Math.floor(s/60);
+      const r = s % 60;
+      return m + ":" + String(r).padStart(2,"0");
+    }
+
+    function tick(){
+      const now = Date.now();
+      const left = (loginAt + timeoutMs) - now;
+      if(el) el.textContent = fmt(left);
+      if(left <= 0) window.location.replace("/login");
+    }
+
+    tick();
+    setInterval(tick, 1000);
+  })();
   </script>
 </body>
 </html>
 """
 
-LOGIN_TEMPLATE = r"""
+
+CHARTS_TEMPLATE = r"""
 <!doctype html>
 <html>
 <head>
   <meta charset="utf-8"/>
   <meta name="viewport" content="width=device-width,initial-scale=1"/>
-  <title>Login - CareTrust Watch</title>
+  <title>CareTrust Watch Charts</title>
   __PWA_HEAD__
   <style>
-    :root{
-      --bg: #0f172a;
-      --panel: #020617;
-      --text: #e5e7eb;
-      --muted: #94a3b8;
-      --border:#1f2937;
-      --field:#0b1220;
-    }
-    .light{
-      --bg:#f6f7f9;
-      --panel:#ffffff;
-      --text:#0f172a;
-      --muted:#475569;
-      --border:#e5e7eb;
-      --field:#ffffff;
-    }
-    body{
-      font-family:system-ui,Segoe UI,Arial;
-      margin:0;min-height:100vh;display:grid;place-items:center;
-      background:var(--bg);color:var(--text);
-    }
-    .card{
-      background:var(--panel);
-      border:1px solid var(--border);
-      border-radius:14px;padding:22px;
-      min-width:320px;max-width:420px;
-      box-shadow:0 10px 30px rgba(0,0,0,.18);
-      width:min(420px, calc(100vw - 36px));
-    }
-    h2{margin:0 0 12px 0}
-    label{display:block;font-size:13px;color:var(--muted);margin:10px 0 6px}
-    input{
-      width:100%;padding:10px 12px;
-      border:1px solid var(--border);
-      border-radius:10px;font-size:16px;
-      background:var(--field);color:var(--text);
-    }
-    button{
-      margin-top:14px;width:100%;
-      padding:10px 12px;border-radius:10px;
-      border:1px solid var(--border);
-      background:#111;color:#fff;font-size:16px;cursor:pointer;
-    }
-    .err{margin-top:10px;color:#b91c1c;font-size:14px}
-    .hint{margin-top:10px;color:var(--muted);font-size:12px;line-height:1.35}
-
-    .toggle{
-      position:fixed;top:14px;right:14px;
-      display:inline-flex;align-items:center;gap:8px;
-      padding:8px 10px;border-radius:12px;
-      border:1px solid var(--border);
-      background:var(--panel);color:var(--text);
-      cursor:pointer;z-index:1000;
-    }
+    :root{--bg:#0f172a;--panel:#020617;--text:#e5e7eb;--muted:#94a3b8;--border:#1f2937;--chip:#0b1220;--bar:#60a5fa}
+    .light{--bg:#f6f7f9;--panel:#ffffff;--text:#0f172a;--muted:#475569;--border:#e5e7eb;--chip:#f1f5f9;--bar:#2563eb}
+    body{font-family:system-ui,Segoe UI,Arial;margin:24px;max-width:980px;background:var(--bg);color:var(--text)}
+    a{color:var(--text)}
+    .top{display:flex;justify-content:space-between;align-items:center;gap:12px;flex-wrap:wrap}
+    .row{display:flex;gap:16px;flex-wrap:wrap}
+    .card{border:1px solid var(--border);border-radius:12px;padding:16px;flex:1;min-width:200px;background:var(--panel)}
+    .k{color:var(--muted);font-size:12px;text-transform:uppercase;letter-spacing:.04em}
+    .v{font-size:20px;margin-top:4px}
+    select,button{font-size:16px;padding:10px 12px;border-radius:10px;border:1px solid var(--border);background:var(--chip);color:var(--text)}
+    .hint{color:var(--muted);font-size:13px}
+    .pill{display:inline-flex;gap:8px;align-items:center;padding:8px 10px;border:1px solid var(--border);border-radius:999px;background:var(--chip);font-size:13px;color:var(--text)}
+    svg{width:100%;height:140px;margin-top:8px;display:block}
+    svg rect{fill:var(--bar)}
+    .toggle{position:fixed;top:14px;right:14px;display:inline-flex;align-items:center;gap:8px;padding:8px 10px;border-radius:12px;border:1px solid var(--border);background:var(--panel);color:var(--text);cursor:pointer;z-index:1000}
     .dot{width:10px;height:10px;border-radius:999px;background:var(--text);opacity:.8}
   </style>
 </head>
@@ -414,20 +2869,63 @@ LOGIN_TEMPLATE = r"""
     <span id="themeLabel" style="font-size:13px;">System</span>
   </button>
 
-  <div class="card">
-    <h2>CareTrust Watch</h2>
-    <form method="post">
-      <label>Username</label>
-      <input name="username" autocomplete="username" required />
-      <label>Password</label>
-      <input name="password" type="password" autocomplete="current-password" required />
-      <button type="submit">Sign in</button>
-      {% if error %}<div class="err">{{ error }}</div>{% endif %}
-      <div class="hint">
-        Tip: Click theme button to cycle <b>System → Dark → Light</b>.
-      </div>
+  {% macro bars(points, field, peak) %}
+  <svg viewBox="0 0 {{ points|length }} 100" preserveAspectRatio="none">
+    {% for p in points %}{% set v = p[field] or 0 %}{% if v %}
+    <rect x="{{ loop.index0 }}" y="{{ 100 - v / peak * 100 }}" width="0.9" height="{{ v / peak * 100 }}"><title>{{ p.label }}: {{ v }}</title></rect>
+    {% endif %}{% endfor %}
+  </svg>
+  {% endmacro %}
+
+  <div class="top">
+    <div>
+      <h2 style="margin:0">Charts</h2>
+      <div class="hint">Hourly rollups{% if room %} for {{ room }}{% endif %}, last {{ days }} day(s)</div>
       <div class="hint" id="themeHint">Auto (follows device)</div>
-    </form>
+    </div>
+    <div style="display:flex;gap:10px;align-items:center;flex-wrap:wrap">
+      <a class="pill" href="/dashboard">Dashboard</a>
+      <a class="pill" href="/logout">Logout</a>
+    </div>
+  </div>
+
+  <form method="get" class="card" style="margin-top:16px;display:flex;gap:10px;flex-wrap:wrap;align-items:center">
+    {% if sources|length > 1 %}
+    <select name="source">
+      {% for s in sources %}<option value="{{ s.id }}" {% if s.id == current_source %}selected{% endif %}>{{ s.name }}</option>{% endfor %}
+    </select>
+    {% endif %}
+    <select name="room">
+      <option value="">All rooms</option>
+      {% for r in rooms %}<option {% if r == room %}selected{% endif %}>{{ r }}</option>{% endfor %}
+    </select>
+    <select name="days">
+      {% for d in (1, 7, 30, 90) %}<option value="{{ d }}" {% if d == days %}selected{% endif %}>{{ d }} day{{ "s" if d > 1 }}</option>{% endfor %}
+    </select>
+    <button type="submit">Show</button>
+  </form>
+
+  <div class="row" style="margin-top:16px">
+    <div class="card"><div class="k">Tokens served</div><div class="v">{{ served }}</div></div>
+    <div class="card"><div class="k">Advances</div><div class="v">{{ advances }}</div></div>
+    <div class="card"><div class="k">Avg time between advances</div><div class="v">{{ "%.0f s"|format(avg_gap) if avg_gap is not none else "—" }}</div></div>
+  </div>
+
+  <div class="card" style="margin-top:16px">
+    <div class="k">Tokens served per hour</div>
+    {{ bars(hourly, "served", peak_served) }}
+    <div class="hint">{{ hourly[0].label }} → {{ hourly[-1].label }}</div>
+  </div>
+
+  <div class="card" style="margin-top:16px">
+    <div class="k">Average seconds between advances, per hour</div>
+    {{ bars(hourly, "avg_gap", peak_gap) }}
+  </div>
+
+  <div class="card" style="margin-top:16px">
+    <div class="k">Busiest hours of the day (tokens per hour, averaged)</div>
+    {{ bars(busiest, "served", peak_busiest) }}
+    <div class="hint" style="display:flex;justify-content:space-between"><span>00:00</span><span>12:00</span><span>23:00</span></div>
   </div>
 
   __THEME_JS__
@@ -435,61 +2933,32 @@ LOGIN_TEMPLATE = r"""
 </html>
 """
 
-DASH_TEMPLATE = r"""
+
+CONFIG_TEMPLATE = r"""
 <!doctype html>
 <html>
 <head>
   <meta charset="utf-8"/>
   <meta name="viewport" content="width=device-width,initial-scale=1"/>
-  <title>CareTrust Watch Dashboard</title>
+  <title>CareTrust Watch Settings</title>
   __PWA_HEAD__
   <style>
-    :root{
-      --bg: #0f172a;
-      --panel: #020617;
-      --text: #e5e7eb;
-      --muted: #94a3b8;
-      --border:#1f2937;
-      --chip:#0b1220;
-    }
-    .light{
-      --bg:#f6f7f9;
-      --panel:#ffffff;
-      --text:#0f172a;
-      --muted:#475569;
-      --border:#e5e7eb;
-      --chip:#f1f5f9;
-    }
-    body{
-      font-family:system-ui,Segoe UI,Arial;
-      margin:24px;max-width:980px;
-      background:var(--bg);color:var(--text);
-    }
+    :root{--bg:#0f172a;--panel:#020617;--text:#e5e7eb;--muted:#94a3b8;--border:#1f2937;--chip:#0b1220}
+    .light{--bg:#f6f7f9;--panel:#ffffff;--text:#0f172a;--muted:#475569;--border:#e5e7eb;--chip:#f1f5f9}
+    body{font-family:system-ui,Segoe UI,Arial;margin:24px;max-width:980px;background:var(--bg);color:var(--text)}
     a{color:var(--text)}
     .top{display:flex;justify-content:space-between;align-items:center;gap:12px;flex-wrap:wrap}
-    .row{display:flex;gap:16px;flex-wrap:wrap}
-    .card{border:1px solid var(--border);border-radius:12px;padding:16px;flex:1;min-width:280px;background:var(--panel)}
-    .k{color:var(--muted);font-size:12px;text-transform:uppercase;letter-spacing:.04em}
-    .v{font-size:20px;margin-top:4px}
-    input,button{font-size:16px;padding:10px 12px;border-radius:10px;border:1px solid var(--border);background:var(--chip);color:var(--text)}
-    button{cursor:pointer}
-    .btn{border:1px solid var(--border);background:#111;color:#fff}
-    .btn2{border:1px solid var(--border);background:transparent;color:var(--text)}
-    pre{white-space:pre-wrap;background:var(--chip);border:1px solid var(--border);padding:12px;border-radius:12px;max-height:360px;overflow:auto;color:var(--text)}
+    .card{border:1px solid var(--border);border-radius:12px;padding:16px;background:var(--panel)}
     .hint{color:var(--muted);font-size:13px}
+    .err{color:#ef4444;font-size:14px}
     .pill{display:inline-flex;gap:8px;align-items:center;padding:8px 10px;border:1px solid var(--border);border-radius:999px;background:var(--chip);font-size:13px;color:var(--text)}
-    code{background:rgba(255,255,255,.06);padding:2px 6px;border-radius:8px;border:1px solid var(--border)}
-
-    .toggle{
-      position:fixed;top:14px;right:14px;
-      display:inline-flex;align-items:center;gap:8px;
-      padding:8px 10px;border-radius:12px;
-      border:1px solid var(--border);
-      background:var(--panel);color:var(--text);
-      cursor:pointer;z-index:1000;
-    }
+    input,button{font-size:14px;padding:6px 8px;border-radius:8px;border:1px solid var(--border);background:var(--chip);color:var(--text)}
+    button{cursor:pointer}
+    table{width:100%;border-collapse:collapse;font-size:14px}
+    th,td{text-align:left;padding:6px 8px;border-bottom:1px solid var(--border);vertical-align:middle}
+    th{color:var(--muted);font-weight:normal;font-size:12px;text-transform:uppercase;letter-spacing:.04em}
+    .toggle{position:fixed;top:14px;right:14px;display:inline-flex;align-items:center;gap:8px;padding:8px 10px;border-radius:12px;border:1px solid var(--border);background:var(--panel);color:var(--text);cursor:pointer;z-index:1000}
     .dot{width:10px;height:10px;border-radius:999px;background:var(--text);opacity:.8}
-    .countdown{font-variant-numeric: tabular-nums;}
   </style>
 </head>
 <body>
@@ -498,163 +2967,758 @@ DASH_TEMPLATE = r"""
     <span id="themeLabel" style="font-size:13px;">System</span>
   </button>
 
-  <div class="top">
-    <div>
-      <h2 style="margin:0">CareTrust Watch Dashboard</h2>
-      <div class="hint">Telegram: <code>/startwatch Room 09</code>, <code>/stopwatch</code>, <code>/status</code></div>
-      <div class="hint" id="themeHint">Auto (follows device)</div>
-    </div>
-    <div style="display:flex;gap:10px;align-items:center;flex-wrap:wrap">
-      <span class="pill">Session expires in: <span class="countdown" id="sessionCountdown">—</span></span>
-      <a class="pill" href="/logout">Logout</a>
-    </div>
-  </div>
+  <div class="top">
+    <div>
+      <h2 style="margin:0">Settings</h2>
+      <div class="hint">Picked up by the running watcher within {{ check }} s, no restart. Telegram: <code>/set NAME value</code>, <code>/set NAME default</code></div>
+      <div class="hint" id="themeHint">Auto (follows device)</div>
+    </div>
+    <div style="display:flex;gap:10px;align-items:center;flex-wrap:wrap">
+      <a class="pill" href="/dashboard">Dashboard</a>
+      <a class="pill" href="/logout">Logout</a>
+    </div>
+  </div>
+
+  {% if error %}<p class="err">{{ error }}</p>{% endif %}
+
+  <div class="card" style="margin-top:16px">
+    <table>
+      <tr><th>Setting</th><th>Value</th><th>Default</th></tr>
+      {% for r in rows %}
+      <tr>
+        <td><code>{{ r.name }}</code>{% if r.override %} ✏️{% endif %}<div class="hint">{{ r.type }}{% if r.min is not none %} {{ r.min }}–{{ r.max }}{% endif %}</div></td>
+        <td>
+          <form method="post" style="display:flex;gap:6px">
+            <input type="hidden" name="name" value="{{ r.name }}"/>
+            <input name="value" value="{{ r.value if r.value is not none else '' }}" style="flex:1;min-width:120px"/>
+            <button name="do" value="set">Save</button>
+            {% if r.override %}<button name="do" value="reset">Reset</button>{% endif %}
+          </form>
+        </td>
+        <td class="hint">{{ r.default if r.default is not none else "—" }}</td>
+      </tr>
+      {% endfor %}
+    </table>
+  </div>
+
+  __THEME_JS__
+</body>
+</html>
+"""
+
+
+def login_required(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not session.get("logged_in"):
+            return redirect(url_for("login", next=request.path))
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+def chat_allowed(chat_id: str) -> bool:
+    # If CHAT_ID is set, only accept commands from that chat (plus ALLOWED_CHATS)
+    if not CHAT_ID or chat_id == str(CHAT_ID):
+        return True
+    return "*" in ALLOWED_CHATS or chat_id in ALLOWED_CHATS
+
+
+def split_source(arg: str):
+    """'male Room 09' -> ('male', 'Room 09') when the first word names a source."""
+    parts = arg.split(maxsplit=1)
+    if parts and len(SOURCES) > 1:
+        for sid in SOURCES:
+            if parts[0].lower() == sid.lower():
+                return sid, (parts[1].strip() if len(parts) > 1 else "")
+    return default_source_id(), arg.strip()
+
+
+def status_text(state, chat) -> str:
+    subs = state["subs"].get(str(chat), {})
+    if not subs:
+        return "📊 No rooms watched.\nUse /startwatch Room 09"
+    lines = []
+    for source_id, sub in subs.items():
+        status = "ON ✅" if sub.get("enabled") else "OFF 🛑"
+        snap = BOARD.get(source_id)
+        lines.append(
+            f"📊 Status{source_label(source_id)}: {status}\n"
+            f"Room: {sub.get('room')}\n"
+            f"Current: {sub.get('current_value')}\n"
+            f"Last alerted: {sub.get('last_value')}"
+            + (f"\nChecked: {now_str(snap['fetched_at'])}" if snap else "")
+        )
+    return "\n\n".join(lines)
+
+
+def handle_commands():
+    updates = get_updates(load_state().get("update_offset"))
+    if not updates:
+        return
+
+    status_chats = []
+    with edit_state() as state:
+        for u in updates:
+            state["update_offset"] = u["update_id"] + 1
+
+            msg = u.get("message", {})
+            text = msg.get("text", "")
+            chat_id = str(msg.get("chat", {}).get("id"))
+
+            if not chat_allowed(chat_id):
+                continue
+
+            parts = text.strip().split(maxsplit=1)
+            cmd = parts[0].lower() if parts else ""
+            arg = parts[1] if len(parts) > 1 else ""
+
+            if cmd == "/startwatch":
+                source_id, room = split_source(arg)
+                if not room:
+                    reply("❌ Usage: /startwatch [source] Room 09", chat_id)
+                else:
+                    room, hints = resolve_room(source_id or default_source_id(), room)
+                    set_watch(state, True, room, chat_id, source_id)
+                    if hints:
+                        reply(f"ℹ️ {room} is not on the board right now. Did you mean: {', '.join(hints)}?", chat_id)
+
+            elif cmd == "/stopwatch":
+                if arg.strip():
+                    set_watch(state, False, chat=chat_id, source_id=split_source(arg)[0])
+                else:
+                    for source_id in list(state["subs"].get(chat_id, {})) or [default_source_id()]:
+                        set_watch(state, False, chat=chat_id, source_id=source_id)
+
+            elif cmd == "/status":
+                status_chats.append(chat_id)  # answered below, after a fresh fetch
+
+            elif cmd == "/live":
+                on = arg.strip().lower() not in ("off", "0", "no")
+                chat = state["chats"].setdefault(chat_id, {})
+                chat["live"] = on
+                chat["live_text"] = None  # (re)post on the next live update
+                if on:
+                    chat["digest"] = None
+                else:
+                    chat["live_msg_id"] = None
+                reply(
+                    "📌 Live board ON: one pinned message will be kept up to date." if on
+                    else "Live board OFF: back to one message per change.",
+                    chat_id,
+                )
+
+            elif cmd == "/digest":
+                chat = state["chats"].setdefault(chat_id, {})
+                word = arg.strip().lower()
+                if not word:
+                    reply(
+                        f"🗞 Digest every {chat['digest']} min" if chat.get("digest")
+                        else "🗞 Digest is off. Use /digest 5 to batch changes every 5 minutes.",
+                        chat_id,
+                    )
+                elif word in ("off", "0"):
+                    chat["digest"] = None
+                    reply("🗞 Digest OFF: back to one message per change.", chat_id)
+                elif word.isdigit() and 1 <= int(word) <= DIGEST_MAX_MINUTES:
+                    chat.update(digest=int(word), live=False)
+                    reply(f"🗞 Digest ON: changes are summarised every {word} min.", chat_id)
+                else:
+                    reply(f"❌ Usage: /digest <1-{DIGEST_MAX_MINUTES} minutes> or /digest off", chat_id)
+
+            elif cmd == "/alertat":
+                source_id, target = split_source(arg)
+                sub = state["subs"].get(chat_id, {}).get(source_id)
+                if not sub or not sub.get("room"):
+                    reply("❌ Start watching a room first: /startwatch Room 09", chat_id)
+                elif target.lower() in ("off", ""):
+                    sub["alert_at"] = None
+                    reply(f"🔕 Turn alert off for {sub['room']}", chat_id)
+                elif not target.isdigit():
+                    reply("❌ Usage: /alertat [source] 45  (or /alertat off)", chat_id)
+                else:
+                    sub["alert_at"], sub["alert_fired"] = int(target), False
+                    reply(
+                        f"⏰ Will alert when {sub['room']}{source_label(source_id)} "
+                        f"is within {ALERT_MARGIN} of {target}",
+                        chat_id,
+                    )
+
+            elif cmd == "/notify":
+                source_id, rest = split_source(arg)
+                sub = state["subs"].get(chat_id, {}).get(source_id)
+                channel, _, address = rest.partition(" ")
+                channel, address = channel.lower(), address.strip()
+                notifier = NOTIFIERS.get(channel)
+                if not sub or not sub.get("room"):
+                    reply("❌ Start watching a room first: /startwatch Room 09", chat_id)
+                elif not channel:
+                    reply(f"📣 Alerts for {sub['room']} go to {sub.get('notify') or 'this chat'}", chat_id)
+                elif channel == "telegram":
+                    sub["notify"] = None
+                    reply(f"📣 Alerts for {sub['room']} come to this chat", chat_id)
+                elif not notifier or not notifier.enabled():
+                    channels = ", ".join(n.name for n in NOTIFIERS.values() if n.enabled())
+                    reply(f"❌ Usage: /notify [source] telegram|email <address>|webhook <url> (available: {channels})", chat_id)
+                elif not notifier.valid(address):
+                    reply(f"❌ Not a usable {channel} address: {address or '(empty)'}", chat_id)
+                else:
+                    sub["notify"] = f"{channel}:{address}"
+                    log_event(f"Alerts for {sub['room']} now go to {channel}", room=sub["room"], kind="watch")
+                    reply(f"📣 Alerts for {sub['room']} now go to {channel} {address}", chat_id)
+
+            elif cmd == "/set":
+                name, _, value = arg.strip().partition(" ")
+                name, value = name.upper(), value.strip()
+                if chat_id not in ADMIN_CHATS:
+                    reply("❌ /set is for admin chats only", chat_id)
+                elif not name:
+                    reply("⚙️ Settings:\n" + "\n".join(
+                        f"{r['name']} = {r['value']}" + (" ✏️" if r["override"] else "") for r in SETTINGS.rows()
+                    ), chat_id)
+                elif name not in TUNABLES:
+                    reply(f"❌ {name} is not a runtime setting", chat_id)
+                elif not value:
+                    reply(f"⚙️ {name} = {globals()[name]}", chat_id)
+                else:
+                    try:
+                        SETTINGS.set(name, None if value.lower() == "default" else value)
+                    except ValueError as e:
+                        reply(f"❌ {e}", chat_id)
+                    else:
+                        reply(f"⚙️ {name} = {globals()[name]}", chat_id)
+
+            elif cmd == "/sources":
+                reply(
+                    "🏥 Sources:\n" + "\n".join(f"• {s.id} — {s.name}" for s in SOURCES.values()),
+                    chat_id,
+                )
+
+    # Outside the state lock: refreshing takes it again
+    for chat_id in dict.fromkeys(status_chats):
+        state = load_state()
+        for source_id, sub in state["subs"].get(chat_id, {}).items():
+            if sub.get("enabled") and source_id in SOURCES:
+                try:
+                    refresh_source(SOURCES[source_id])
+                except Exception as e:
+                    log_event(f"Refresh failed ({source_id}): {e}", level="error", kind="error")
+        reply(status_text(load_state(), chat_id), chat_id)
+
+
+def token_number(value):
+    m = re.search(r"\d+", value or "")
+    return int(m.group()) if m else None
+
+
+def turn_near(sub) -> bool:
+    """Has this subscription reached its /alertat threshold (once per target)?"""
+    target, current = sub.get("alert_at"), token_number(sub.get("current_value"))
+    if target is None or current is None:
+        return False
+    if current < target - ALERT_MARGIN:
+        sub["alert_fired"] = False  # e.g. counters reset for a new day
+        return False
+    if sub.get("alert_fired"):
+        return False
+    sub["alert_fired"] = True
+    return True
+
+
+def apply_board(state, source_id: str, values: dict, index: SubIndex | None = None):
+    """
+    Update every subscription on this source; returns the (chat, text,
+    priority) messages to send. The columns of `index` (the state's SubIndex,
+    built here if not given) pick the subscriptions, so only those whose room
+    is on the board are looked up in the state.
+    """
+    outbox = []
+    index = index or SubIndex(state)
+    for chat, room in index.subs_on(source_id, values):
+        sub = state["subs"].get(chat, {}).get(source_id)
+        if not sub or not sub.get("enabled") or sub.get("room") != room:
+            continue  # changed after the index was built
+        current_value = values[room]
+        sub["current_value"] = current_value
+        if not current_value:
+            continue
+
+        last_value = sub.get("last_value")
+        where = source_label(source_id)
+        # Live-board and digest chats see changes there; threshold alerts always get their own message
+        cfg = state["chats"].get(chat, {})
+        if last_value is None:
+            sub["last_value"] = current_value
+            log_event(f"Initial value for {room}{where}: {current_value}", room=room, kind="change")
+        elif current_value != last_value:
+            if cfg.get("digest"):
+                add_to_digest(cfg, source_id, room, last_value, current_value)
+            elif not cfg.get("live"):
+                outbox.append((sub_dest(chat, sub), (
+                    f"🔔 CareTrust update\n{room}{where} changed\n"
+                    f"From: {last_value}\nTo:   {current_value}"
+                ), CHANGE))
+            log_event(f"{room}{where} changed: {last_value} -> {current_value}", room=room, kind="change")
+            sub["last_value"] = current_value
+
+        if turn_near(sub):
+            outbox.append((sub_dest(chat, sub), f"⏰ Your turn is near!\n{room}{where} is at {current_value} (alert at {sub['alert_at']})", URGENT))
+            log_event(f"{room}{where} reached alert threshold {sub['alert_at']}", room=room, kind="alert")
+    return outbox
+
+
+def add_to_digest(cfg, source_id, room, old, new):
+    pending = cfg.setdefault("pending", {})
+    if not pending:
+        cfg["digest_since"] = CLOCK.time()
+    entry = pending.get(f"{source_id}|{room}")
+    if entry:
+        entry[1], entry[2] = new, entry[2] + 1  # collapse to first -> last
+    else:
+        pending[f"{source_id}|{room}"] = [old, new, 1]
+
+
+def digest_text(cfg, pending=None) -> str:
+    """The digest message; "" if every room ended where it started (e.g. 12 → 13 → 12)."""
+    lines = ["🗞 CareTrust digest" + (f" ({cfg['digest']} min)" if cfg.get("digest") else "")]
+    for key, (old, new, n) in sorted((cfg["pending"] if pending is None else pending).items()):
+        if old == new:
+            continue
+        source_id, room = key.split("|", 1)
+        times = f" ({n} changes)" if n > 1 else ""
+        lines.append(f"{room}{source_label(source_id)}: {old} → {new}{times}")
+    return "\n".join(lines) if len(lines) > 1 else ""
+
+
+def digest_due(cfg, now: float) -> bool:
+    return bool(cfg.get("pending")) and now - (cfg.get("digest_since") or now) >= (cfg.get("digest") or 0) * 60
+
+
+def collect_digests(state, now: float):
+    """
+    Pop every digest whose window has elapsed; returns the messages to send.
+    Each room's lines go where its subscription's alerts go (/notify), so a
+    chat whose subscriptions point at different channels gets one digest per
+    destination.
+    """
+    outbox = []
+    for chat, cfg in state["chats"].items():
+        if digest_due(cfg, now):
+            # also flushes what was left when the digest was switched off
+            by_dest = {}
+            for key, entry in cfg["pending"].items():
+                sub = state["subs"].get(chat, {}).get(key.split("|", 1)[0], {})
+                by_dest.setdefault(sub_dest(chat, sub), {})[key] = entry
+            for dest, pending in by_dest.items():
+                text = digest_text(cfg, pending)
+                if text:
+                    outbox.append((dest, text, CHANGE))
+            cfg["pending"], cfg["digest_since"] = {}, None
+    return outbox
+
+
+def flush_digests(now: float | None = None):
+    """Send every digest that is due. Cheap when nothing is."""
+    now = now if now is not None else CLOCK.time()
+    if not any(digest_due(cfg, now) for cfg in load_state()["chats"].values()):
+        return
+    with edit_state() as state:
+        OUTBOX.extend(collect_digests(state, now))
+
+
+def live_text(state, chat) -> str:
+    lines, changed = ["📋 Live board"], 0
+    for source_id, sub in state["subs"].get(str(chat), {}).items():
+        if not sub.get("enabled") or not sub.get("room"):
+            continue
+        target = f" (alert at {sub['alert_at']})" if sub.get("alert_at") is not None else ""
+        lines.append(f"{sub['room']}{source_label(source_id)}: {sub.get('current_value') or '—'}{target}")
+        snap = BOARD.get(source_id)
+        changed = max(changed, snap["changed_at"] if snap else 0)
+    if len(lines) == 1:
+        lines.append("No rooms watched. Use /startwatch Room 09")
+    if changed:
+        lines.append(f"\nLast change: {now_str(changed)}")
+    return "\n".join(lines)
+
+
+def live_api(method: str, **data):
+    """telegram_api behind the outbox's shared Telegram bucket: live edits count against OUTBOX_RATE too."""
+    telegram = NOTIFIERS["telegram"]
+    while not take_token(f"notify:{telegram.name}", telegram.rate, 1):
+        time.sleep(1 / max(telegram.rate, 0.001))
+    return telegram_api(method, **data)
+
+
+def post_live(chat, msg_id, text):
+    """Edit the chat's live message, or post + pin a new one. Returns the message id."""
+    if msg_id:
+        try:
+            live_api("editMessageText", chat_id=chat, message_id=msg_id, text=text)
+            return msg_id
+        except RuntimeError as e:
+            if "not modified" in str(e):
+                return msg_id
+            log_event(f"Live board edit failed in {chat}: {e}; reposting", level="warning", kind="telegram")
+    msg_id = live_api("sendMessage", chat_id=chat, text=text)["message_id"]
+    try:
+        live_api("pinChatMessage", chat_id=chat, message_id=msg_id, disable_notification="true")
+    except RuntimeError as e:
+        log_event(f"Could not pin live board in {chat}: {e}", level="warning", kind="telegram")
+    return msg_id
+
+
+def update_live_boards():
+    """One pass: re-render each live chat and touch Telegram only if the text changed."""
+    state = load_state()
+    posted = {}
+    for chat, cfg in state["chats"].items():
+        if not cfg.get("live"):
+            continue
+        text = live_text(state, chat)
+        if text == cfg.get("live_text"):
+            continue
+        try:
+            posted[chat] = (post_live(chat, cfg.get("live_msg_id"), text), text)
+        except BreakerOpen:
+            break
+        except Exception as e:
+            log_event(f"Live board update failed in {chat}: {e}", level="error", kind="telegram")
+    if posted:
+        with edit_state() as state:
+            for chat, (msg_id, text) in posted.items():
+                state["chats"].setdefault(chat, {}).update(live_msg_id=msg_id, live_text=text)
+
+
+def live_loop():
+    # Runs every debounce window, so each chat gets at most one edit per window
+    while True:
+        time.sleep(max(1, LIVE_DEBOUNCE))  # the env value is not range-checked
+        try:
+            update_live_boards()
+        except Exception as e:
+            log_event(f"Live board error: {e}", level="error", kind="telegram")
+
+
+def record_rollups(source_id: str, before: dict, after: dict, now: float):
+    """
+    Fold the advances between two consecutive boards into the room's hourly
+    bucket: how often it moved, how many tokens that covered, and the time
+    since its previous advance. Charts only ever read these buckets.
+    """
+    hour = int(now // 3600 * 3600)
+    conn = db()
+    seen = set()
+    for room, value in after.items():
+        key = room_key(room)
+        new, old = token_number(value), token_number(before.get(room))
+        if key in seen or new is None or old is None or new == old:
+            continue
+        seen.add(key)
+        served = new - old if new > old else 0  # counters reset, e.g. for a new day
+        mark = conn.execute("SELECT ts FROM room_marks WHERE source = ? AND room = ?", (source_id, room)).fetchone()
+        gap = now - mark[0] if mark and now - mark[0] <= ROLLUP_MAX_GAP else None
+        conn.execute(
+            "INSERT INTO rollups VALUES (?, ?, ?, 1, ?, ?, ?) ON CONFLICT (source, hour, room) DO UPDATE SET "
+            "advances = advances + 1, served = served + excluded.served, "
+            "gap_sum = gap_sum + excluded.gap_sum, gaps = gaps + excluded.gaps",
+            (source_id, room, hour, served, gap or 0.0, 0 if gap is None else 1),
+        )
+        conn.execute("INSERT OR REPLACE INTO room_marks VALUES (?, ?, ?)", (source_id, room, now))
+
+
+def prune_store(now: float | None = None):
+    """Retention: drop rollups past ROLLUP_DAYS and history/deliveries past HISTORY_DAYS."""
+    now = now if now is not None else CLOCK.time()
+    conn = db()
+    conn.execute("DELETE FROM rollups WHERE hour < ?", (int(now // 3600 * 3600) - ROLLUP_DAYS * 86400,))
+    conn.execute("DELETE FROM history WHERE ts < ?", (now - HISTORY_DAYS * 86400,))
+    conn.execute("DELETE FROM deliveries WHERE ts < ?", (now - HISTORY_DAYS * 86400,))
+
+
+def record_history(source_id: str, before: dict, after: dict, now: float):
+    """One history row per room whose value changed between two boards."""
+    rows = [(now, source_id, room, value) for room, value in after.items() if before.get(room) != value]
+    if rows:
+        db().executemany("INSERT INTO history (ts, source, room, value) VALUES (?, ?, ?, ?)", rows)
+
 
-  <div class="row" style="margin-top:16px">
-    <div class="card">
-      <div class="k">Status</div>
-      <div class="v">{{ "ON ✅" if enabled else "OFF 🛑" }}</div>
-      <div class="k" style="margin-top:12px">Room</div>
-      <div class="v">{{ room or "—" }}</div>
-    </div>
+# name -> (columns, table, filterable columns); ts is also exported as a readable time
+EXPORTS = {
+    "history": (("ts", "source", "room", "value"), "history", ("source", "room")),
+    "events": (EVENT_FIELDS, "events", ("room", "kind", "level")),
+    "deliveries": (("ts", "chat", "status", "tries", "text"), "deliveries", ("chat", "status")),
+}
 
-    <div class="card">
-      <div class="k">Current value</div>
-      <div class="v">{{ current_value or "—" }}</div>
-      <div class="k" style="margin-top:12px">Last alerted value</div>
-      <div class="v">{{ last_value or "—" }}</div>
-    </div>
-  </div>
 
-  <div class="card" style="margin-top:16px">
-    <form method="post" action="/action">
-      <div class="k">Controls</div>
-      <div style="display:flex;gap:10px;flex-wrap:wrap;margin-top:10px;align-items:center">
-        <input name="room" placeholder="Room 09" value="{{ room or '' }}"/>
-        <button class="btn" name="do" value="start">Start</button>
-        <button class="btn2" name="do" value="stop">Stop</button>
-        <button class="btn2" name="do" value="setroom">Set room only</button>
-      </div>
-      <p class="hint">Room label must match the page (e.g. <code>Room 09</code>).</p>
-    </form>
-  </div>
+def export_rows(name: str, since=None, until=None, filters=None):
+    """Rows of one export, oldest first, read from the store in batches."""
+    cols, table, _ = EXPORTS[name]
+    if name == "events" and not EVENT_SPILL:
+        # no spill table: the in-memory ring is all there is (and is bounded)
+        for rec in reversed(EVENTS.page(limit=EVENT_LOG_SIZE)[0]):
+            row = dict(zip(cols, rec))
+            if (since is None or rec[1] >= since) and (until is None or rec[1] < until) and all(
+                row[k] == v for k, v in (filters or {}).items()
+            ):
+                yield rec
+        return
+    sql, args = f"SELECT {', '.join(cols)} FROM {table} WHERE 1=1", []
+    for cond, val in [("ts >= ?", since), ("ts < ?", until)] + [(f"{k} = ?", v) for k, v in (filters or {}).items()]:
+        if val is not None:
+            sql += f" AND {cond}"
+            args.append(val)
+    cur = db().execute(sql + " ORDER BY ts", args)
+    while True:
+        batch = cur.fetchmany(EXPORT_BATCH)
+        if not batch:
+            return
+        yield from batch
 
-  <div class="card" style="margin-top:16px">
-    <div class="k">Event log (latest first)</div>
-    <pre>{{ log_text }}</pre>
-  </div>
 
-  __THEME_JS__
+class _Echo:
+    """File-like object for csv.writer that hands each formatted line back."""
 
-  <script>
-  (function(){
-    const loginAt = Number({{ login_at_ms }}) || 0;
-    const timeoutMs = Number({{ session_timeout_ms }}) || 0;
-    const el = document.getElementById("sessionCountdown");
+    def write(self, line):
+        return line
 
-    function fmt(ms){
-      if(ms <= 0) return "0:00";
-      const s = Math.floor(ms/1000);
-      const m = Math.floor(s/60);
-      const r = s % 60;
-      return m + ":" + String(r).padStart(2,"0");
-    }
 
-    function tick(){
-      const now = Date.now();
-      const left = (loginAt + timeoutMs) - now;
-      if(el) el.textContent = fmt(left);
-      if(left <= 0) window.location.replace("/login");
+def export_stream(name: str, fmt: str, rows):
+    """CSV or NDJSON text in chunks of EXPORT_BATCH rows."""
+    cols = EXPORTS[name][0]
+    ts_at = cols.index("ts")
+    writer = csv.writer(_Echo())
+    chunk = [writer.writerow(("time",) + tuple(cols))] if fmt == "csv" else []
+    for row in rows:
+        if fmt == "csv":
+            chunk.append(writer.writerow((now_str(row[ts_at]),) + tuple(row)))
+        else:
+            chunk.append(json.dumps(dict(zip(cols, row), time=now_str(row[ts_at])), ensure_ascii=False) + "\n")
+        if len(chunk) >= EXPORT_BATCH:
+            yield "".join(chunk)
+            chunk = []
+    if chunk:
+        yield "".join(chunk)
+
+
+def rollup_charts(source_id: str, room: str | None, days: int) -> dict:
+    """Series for the charts view, from at most days * 24 buckets per room."""
+    now = CLOCK.time()
+    start = int(now // 3600 * 3600) - (days * 24 - 1) * 3600
+    sql = "SELECT hour, SUM(advances), SUM(served), SUM(gap_sum), SUM(gaps) FROM rollups WHERE source = ? AND hour >= ?"
+    args = [source_id, start]
+    if room:
+        sql += " AND room = ?"
+        args.append(room)
+    rows = {r[0]: r[1:] for r in db().execute(sql + " GROUP BY hour", args)}
+
+    hourly, by_hour_of_day = [], [[0, 0] for _ in range(24)]  # served, days seen
+    totals = [0, 0, 0.0, 0]
+    for hour in range(start, start + days * 24 * 3600, 3600):
+        advances, served, gap_sum, gaps = rows.get(hour, (0, 0, 0.0, 0))
+        hourly.append({
+            "hour": hour, "label": datetime.fromtimestamp(hour).strftime("%d %b %H:00"),
+            "advances": advances, "served": served, "avg_gap": round(gap_sum / gaps, 1) if gaps else None,
+        })
+        slot = by_hour_of_day[datetime.fromtimestamp(hour).hour]
+        slot[0] += served
+        slot[1] += 1
+        for i, v in enumerate((advances, served, gap_sum, gaps)):
+            totals[i] += v
+    busiest = [{"hour": h, "served": round(s / n, 1) if n else 0} for h, (s, n) in enumerate(by_hour_of_day)]
+    return {
+        "source": source_id, "room": room, "days": days, "hourly": hourly, "busiest": busiest,
+        "advances": totals[0], "served": totals[1],
+        "avg_gap": round(totals[2] / totals[3], 1) if totals[3] else None,
+        "rooms": [r[0] for r in db().execute(
+            "SELECT DISTINCT room FROM rollups WHERE source = ? AND hour >= ? ORDER BY room", (source_id, start)
+        )],
     }
 
-    tick();
-    setInterval(tick, 1000);
-  })();
-  </script>
-</body>
-</html>
-"""
 
+def poll_source(src: Source, rooms=None):
+    if rooms is None:
+        rooms = sub_index().watched.get(src.id, ())
+    if not rooms:
+        return BOARD.get(src.id)
 
-def login_required(fn):
-    @wraps(fn)
-    def wrapper(*args, **kwargs):
-        if not session.get("logged_in"):
-            return redirect(url_for("login", next=request.path))
-        return fn(*args, **kwargs)
-    return wrapper
+    # Fetch + parse without holding the state lock
+    try:
+        values = read_board(src, rooms)
+    except (StaleParse, BreakerOpen):
+        return BOARD.get(src.id)
 
+    ok, notices = SELFCHECK.check(src, rooms, values)
+    OUTBOX.extend(notices)
+    if not ok:
+        return BOARD.get(src.id)
 
-def handle_commands(state):
-    updates = get_updates(state.get("update_offset"))
-    for u in updates:
-        state["update_offset"] = u["update_id"] + 1
+    prev = BOARD.get(src.id)
+    snap = BOARD.publish(src.id, values)
+    if not prev or snap["version"] != prev["version"]:
+        before = prev.values if prev else {}
+        try:
+            record_history(src.id, before, values, snap["fetched_at"])
+            if prev:
+                record_rollups(src.id, before, values, snap["fetched_at"])
+        except sqlite3.Error as e:
+            log_event(f"History error ({src.id}): {e}", level="error", kind="error")
+    with edit_state() as state:
+        # under the lock the file can't change, so the cached index matches `state`;
+        # the alerts are stored before the last_value that produced them
+        OUTBOX.extend(apply_board(state, src.id, values, sub_index()))
+    return snap
 
-        msg = u.get("message", {})
-        text = msg.get("text", "")
-        chat_id = str(msg.get("chat", {}).get("id"))
 
-        # If CHAT_ID is set, only accept commands from that chat
-        if CHAT_ID and chat_id != str(CHAT_ID):
-            continue
+def refresh_source(src: Source, max_age: float | None = None, rooms=None):
+    """
+    Poll a source now unless its snapshot is younger than max_age (default
+    REFRESH_MIN_AGE). Concurrent callers (scheduler, /status, dashboard) share
+    one upstream fetch.
+    """
+    max_age = REFRESH_MIN_AGE if max_age is None else max_age
+    snap = BOARD.get(src.id)
+    if snap and max_age > 0 and time.time() - snap["fetched_at"] < max_age:
+        return snap
+    return FLIGHTS.do(src.id, lambda: poll_source(src, rooms))
 
-        parts = text.strip().split(maxsplit=1)
-        cmd = parts[0].lower() if parts else ""
 
-        if cmd == "/startwatch":
-            if len(parts) < 2:
-                send_telegram("❌ Usage: /startwatch Room 09")
-            else:
-                set_watch(state, True, parts[1].strip())
-
-        elif cmd == "/stopwatch":
-            set_watch(state, False)
-
-        elif cmd == "/status":
-            status = "ON ✅" if state.get("enabled") else "OFF 🛑"
-            send_telegram(
-                f"📊 Status: {status}\n"
-                f"Room: {state.get('room')}\n"
-                f"Current: {state.get('current_value')}\n"
-                f"Last alerted: {state.get('last_value')}"
-            )
+def request_refresh(source_id: str) -> float:
+    """Ask the watcher (whichever process runs it) to refresh a source on its next tick."""
+    now = time.time()
+    db().execute("INSERT OR REPLACE INTO refresh_requests (source, requested_at) VALUES (?, ?)", (source_id, now))
+    return now
+
+
+def take_refresh_requests(max_age: float = 60) -> list:
+    conn = db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute("SELECT source FROM refresh_requests WHERE requested_at >= ?",
+                            (time.time() - max_age,)).fetchall()
+        conn.execute("DELETE FROM refresh_requests")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return [r[0] for r in rows]
+
+
+def commands_loop():
+    while True:
+        try:
+            handle_commands()
+        except BreakerOpen:
+            time.sleep(5)
+        except Exception as e:
+            log_event(f"Telegram command error: {e}", level="error", kind="telegram")
+            time.sleep(POLL_SECONDS)
+
+
+def write_checkpoint():
+    data = {
+        "written_at": time.time(),
+        "board": {
+            sid: [snap.version, snap.fetched_at, snap.changed_at, snap.rooms, snap.cells]
+            for sid, snap in list(BOARD.snaps.items())
+        },
+        "selfcheck": SELFCHECK.snapshot(),
+        # with EVENT_SPILL the store already has them
+        "events": [] if EVENT_SPILL else EVENTS.page(limit=CHECKPOINT_EVENTS)[0][::-1],
+    }
+    os.makedirs(os.path.dirname(CHECKPOINT_PATH) or ".", exist_ok=True)
+    tmp = f"{CHECKPOINT_PATH}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, CHECKPOINT_PATH)
+
+
+def load_checkpoint() -> bool:
+    """Restore what the last run left behind; False on a cold start."""
+    try:
+        with open(CHECKPOINT_PATH, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return False
+    BOARD.seed(data.get("board", {}))
+    OUTBOX.load(data.get("outbox", []))  # only in checkpoints written before the outbox table
+    SELFCHECK.load(data.get("selfcheck", {}))
+    if not EVENT_SPILL:
+        for rec in data.get("events", []):
+            EVENTS.append(tuple(rec))
+    return True
+
+
+def checkpoint_loop():
+    while True:
+        time.sleep(CHECKPOINT_SECONDS)
+        try:
+            write_checkpoint()
+        except Exception as e:
+            log_event(f"Checkpoint error: {e}", level="error", kind="error")
 
 
 def watcher_loop():
-    state = load_state()
-    log_event("Watcher started")
+    warm = load_checkpoint()
+    OUTBOX.recover()  # what the last run (and any dead web worker) had not sent yet
+    load_events()
+    log_event(f"Watcher started ({'warm' if warm else 'cold'}, {len(SOURCES)} source(s))", kind="watcher")
+    threading.Thread(target=checkpoint_loop, name="checkpoint", daemon=True).start()
+    atexit.register(write_checkpoint)
+
+    # Only handle Telegram commands if configured
     if BOT_TOKEN and CHAT_ID:
-        send_telegram("🤖 CareTrust watcher online.\nUse /startwatch Room 09")
+        if not warm:
+            reply("🤖 CareTrust watcher online.\nUse /startwatch Room 09")
+        threading.Thread(target=commands_loop, name="telegram", daemon=True).start()
+        threading.Thread(target=live_loop, name="live-board", daemon=True).start()
 
+    # Each source is polled on its own cadence; fetches run concurrently on a bounded pool
+    pool, workers = ThreadPoolExecutor(FETCH_WORKERS, thread_name_prefix="fetch"), FETCH_WORKERS
+    inflight, last_run, pruned = {}, {}, 0.0
     while True:
         try:
-            # Only handle Telegram commands if configured
-            if BOT_TOKEN and CHAT_ID:
-                handle_commands(state)
-
-            if state.get("enabled") and state.get("room"):
-                page_text = fetch_page_text()
-                current_value = extract_room_value(page_text, state["room"])
-                state["current_value"] = current_value
-
-                if current_value:
-                    last_value = state.get("last_value")
-                    if last_value is None:
-                        state["last_value"] = current_value
-                        log_event(f"Initial value for {state['room']}: {current_value}")
-                    elif current_value != last_value:
-                        send_telegram(
-                            f"🔔 CareTrust update\n{state['room']} changed\n"
-                            f"From: {last_value}\nTo:   {current_value}"
-                        )
-                        log_event(f"{state['room']} changed: {last_value} -> {current_value}")
-                        state["last_value"] = current_value
-
-            save_state(state)
+            SETTINGS.refresh()
+            if workers != FETCH_WORKERS:
+                pool.shutdown(wait=False)  # running fetches finish on the old pool
+                pool, workers = ThreadPoolExecutor(FETCH_WORKERS, thread_name_prefix="fetch"), FETCH_WORKERS
+
+            for source_id, fut in list(inflight.items()):
+                if fut.done():
+                    del inflight[source_id]
+                    if fut.exception():
+                        log_event(f"Watcher error ({source_id}): {fut.exception()}", level="error", kind="error")
+
+            now = time.monotonic()
+            for source_id, rooms in sub_index().watched.items():
+                src = SOURCES[source_id]
+                # measured from the last poll, so a new POLL_SECONDS applies on the next tick
+                if source_id in inflight or now < last_run.get(source_id, 0) + src.interval:
+                    continue
+                last_run[source_id] = now
+                inflight[source_id] = pool.submit(refresh_source, src, 0, rooms)
+
+            start_captures()
+
+            # "Refresh now" from any web process; one already in flight covers it
+            for source_id in take_refresh_requests():
+                if source_id in SOURCES and source_id not in inflight:
+                    last_run[source_id] = now
+                    inflight[source_id] = pool.submit(refresh_source, SOURCES[source_id])
+
+            flush_digests()
+            if now - pruned >= PRUNE_SECONDS:
+                pruned = now
+                prune_store()
+                OUTBOX.recover()
         except Exception as e:
-            log_event(f"Watcher error: {e}")
+            log_event(f"Watcher error: {e}", level="error", kind="error")
+
+        time.sleep(1)
+
 
-        time.sleep(POLL_SECONDS)
+@app.before_request
+def refresh_settings():
+    SETTINGS.refresh()
 
 
 @app.get("/health")
@@ -699,8 +3763,15 @@ def logout():
 @login_required
 def dashboard():
     state = load_state()
-    with LOCK:
-        log_text = "\n".join(list(LOG))
+    recs, cursor = events_page(limit=EVENT_PAGE_SIZE)
+    log_text = "\n".join(format_event(r) for r in recs)
+
+    watches = [
+        dict(sub, chat=chat, source=SOURCES[sid].name if sid in SOURCES else sid)
+        for chat, sid, sub in iter_subs(state)
+    ]
+    source = request.args.get("source") or default_source_id()
+    own = state["subs"].get(DASH_CHAT, {}).get(source, {})
 
     login_at = session.get("login_at") or int(time.time())
     login_at_ms = int(login_at) * 1000
@@ -708,11 +3779,15 @@ def dashboard():
 
     return render_template_string(
         inject(DASH_TEMPLATE),
-        enabled=state.get("enabled"),
-        room=state.get("room"),
-        current_value=state.get("current_value"),
-        last_value=state.get("last_value"),
+        watches=watches,
+        breakers=[dict(b, since=now_str(b["changed_at"])) for b in breaker_rows()],
+        delivery=delivery_lag(),
+        budgets=budget_rows(),
+        sources=list(SOURCES.values()),
+        current_source=source,
+        room=own.get("room"),
         log_text=log_text,
+        log_cursor=cursor,
         login_at_ms=login_at_ms,
         session_timeout_ms=session_timeout_ms,
     )
@@ -721,26 +3796,757 @@ def dashboard():
 @app.post("/action")
 @login_required
 def action():
-    state = load_state()
     do = request.form.get("do")
     room = (request.form.get("room") or "").strip()
+    source_id = request.form.get("source") or default_source_id()
+    if source_id not in SOURCES:
+        return "Unknown source", 400
 
-    if do == "start" and room:
-        set_watch(state, True, room)
-    elif do == "stop":
-        set_watch(state, False)
-    elif do == "setroom" and room:
-        state["room"] = room
-        state["last_value"] = None
-        state["current_value"] = None
-        send_telegram(f"ℹ️ Room set to {room} (monitoring {'ON' if state.get('enabled') else 'OFF'})")
-        log_event(f"Room set to {room} (monitoring unchanged)")
+    if room:
+        room = resolve_room(source_id, room)[0]
+    with edit_state() as state:
+        if do == "start" and room:
+            set_watch(state, True, room, source_id=source_id)
+        elif do == "stop":
+            set_watch(state, False, source_id=source_id)
+        elif do == "setroom" and room:
+            sub = get_sub(state, DASH_CHAT, source_id)
+            sub.update(room=room, last_value=None, current_value=None)
+            where = source_label(source_id)
+            reply(f"ℹ️ Room set to {room}{where} (monitoring {'ON' if sub.get('enabled') else 'OFF'})")
+            log_event(f"Room set to {room}{where} (monitoring unchanged)", room=room, kind="watch")
 
-    save_state(state)
-    return redirect(url_for("dashboard"))
+    if do == "refresh":
+        # The watcher fetches; this request only waits (briefly) for its snapshot
+        asked = request_refresh(source_id)
+        BOARD.wait_for(source_id, lambda snap: snap["fetched_at"] >= asked - REFRESH_MIN_AGE, min(TIMEOUT, 10))
 
+    return redirect(url_for("dashboard", source=source_id))
 
-if __name__ == "__main__":
-    threading.Thread(target=watcher_loop, daemon=True).start()
+
+def chart_args():
+    source_id = request.args.get("source") or default_source_id()
+    try:
+        days = min(max(1, int(request.args.get("days", 7))), 90)
+    except ValueError:
+        days = 7
+    return source_id, request.args.get("room") or None, days
+
+
+@app.get("/dashboard/charts")
+@login_required
+def charts():
+    source_id, room, days = chart_args()
+    if source_id not in SOURCES:
+        return "Unknown source", 404
+    data = rollup_charts(source_id, room, days)
+    for p in data["busiest"]:
+        p["label"] = f"{p['hour']:02d}:00"
+
+    def peak(points, key):
+        return max([p[key] or 0 for p in points] + [1])
+
+    return render_template_string(
+        inject(CHARTS_TEMPLATE),
+        sources=list(SOURCES.values()),
+        current_source=source_id,
+        peak_served=peak(data["hourly"], "served"),
+        peak_gap=peak(data["hourly"], "avg_gap"),
+        peak_busiest=peak(data["busiest"], "served"),
+        **{k: v for k, v in data.items() if k != "source"},
+    )
+
+
+@app.get("/api/rollups")
+@login_required
+def api_rollups():
+    source_id, room, days = chart_args()
+    if source_id not in SOURCES:
+        return jsonify({"error": "unknown source"}), 404
+    return jsonify(rollup_charts(source_id, room, days))
+
+
+@app.get("/export/<name>.<fmt>")
+@login_required
+def export(name, fmt):
+    if name not in EXPORTS or fmt not in ("csv", "ndjson"):
+        return "Unknown export", 404
+    try:
+        since = parse_when(request.args["since"]) if request.args.get("since") else None
+        until = parse_when(request.args["until"]) if request.args.get("until") else None
+    except ValueError:
+        return "since/until must be epoch seconds or ISO times", 400
+    filters = {k: request.args[k] for k in EXPORTS[name][2] if request.args.get(k)}
+    body = export_stream(name, fmt, export_rows(name, since, until, filters))
+    # No Content-Length: the response goes out chunked as the rows are read
+    return Response(body, mimetype="text/csv" if fmt == "csv" else "application/x-ndjson", headers={
+        "Content-Disposition": f'attachment; filename="{name}.{fmt}"',
+        "Cache-Control": "no-store",
+    })
+
+
+@app.get("/api/rooms")
+@login_required
+def api_rooms():
+    source_id = request.args.get("source") or default_source_id()
+    if source_id not in SOURCES:
+        return jsonify({"error": "unknown source"}), 404
+    try:
+        limit = min(max(1, int(request.args.get("limit", 8))), 50)
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    return jsonify({"source": source_id, "rooms": suggest_rooms(source_id, request.args.get("q", ""), limit)})
+
+
+@app.get("/api/events")
+@login_required
+def api_events():
+    try:
+        before = int(request.args["cursor"]) if request.args.get("cursor") else None
+        limit = min(int(request.args.get("limit", EVENT_PAGE_SIZE)), 1000)
+    except ValueError:
+        return jsonify({"error": "cursor and limit must be integers"}), 400
+
+    recs, cursor = events_page(
+        before,
+        max(1, limit),
+        room=request.args.get("room") or None,
+        kind=request.args.get("kind") or None,
+        level=request.args.get("level") or None,
+    )
+    return jsonify({
+        "events": [dict(zip(EVENT_FIELDS, r)) for r in recs],
+        "next_cursor": cursor,
+    })
+
+
+@app.get("/api/board")
+def api_board():
+    if BOARD_TOKEN and not session.get("logged_in"):
+        auth = request.headers.get("Authorization", "")
+        token = auth[7:] if auth.startswith("Bearer ") else request.args.get("token", "")
+        if token != BOARD_TOKEN:
+            return jsonify({"error": "unauthorized"}), 401
+
+    source_id = request.args.get("source") or default_source_id()
+    if source_id not in SOURCES:
+        return jsonify({"error": "unknown source"}), 404
+    try:
+        since = int(request.args.get("since", "-1"))
+        wait = min(float(request.args.get("wait", "0")), BOARD_WAIT_MAX)
+    except ValueError:
+        return jsonify({"error": "since and wait must be numbers"}), 400
+
+    busy = False
+    if since >= 0 and wait > 0 and LONG_POLLS.acquire(blocking=False):
+        try:
+            snap = BOARD.wait(source_id, since, wait)
+        finally:
+            LONG_POLLS.release()
+    else:
+        busy = since >= 0 and wait > 0
+        snap = BOARD.get(source_id)
+    if snap is None:
+        return jsonify({"error": "no data yet"}), 503, {"Retry-After": str(SOURCES[source_id].interval)}
+
+    headers = {
+        "ETag": f'"{snap["etag"]}"',
+        "Cache-Control": f"{'private' if BOARD_TOKEN else 'public'}, max-age={BOARD_MAX_AGE}",
+        "X-Board-Version": str(snap["version"]),
+    }
+    if request.if_none_match.contains(snap["etag"]) or (since >= 0 and snap["version"] <= since):
+        if busy:
+            headers["Retry-After"] = str(max(1, int(wait)))
+        return "", 304, headers
+    return snap["body"], 200, dict(headers, **{"Content-Type": "application/json"})
+
+
+@app.get("/admin/archive")
+@login_required
+def admin_archive():
+    if not ARCHIVE_DIR:
+        return jsonify({"error": "archive disabled (set ARCHIVE_DIR)"}), 404
+    try:
+        since = float(request.args["since"]) if request.args.get("since") else None
+        until = float(request.args["until"]) if request.args.get("until") else None
+        limit = min(int(request.args.get("limit", "500")), 5000)
+    except ValueError:
+        return jsonify({"error": "since/until/limit must be numbers"}), 400
+    rows = archive_index(request.args.get("source") or None, since, until, limit)
+    return jsonify({"pages": [dict(zip(("id", "ts", "source", "sha", "encoding"), r)) for r in rows]})
+
+
+@app.get("/admin/archive/<sha>")
+@login_required
+def admin_archive_page(sha):
+    content = archive_get(sha) if ARCHIVE_DIR and re.fullmatch(r"[0-9a-f]{64}", sha) else None
+    if content is None:
+        return jsonify({"error": "not found"}), 404
+    # served as text so the archived page's scripts never run on our origin
+    return content, 200, {"Content-Type": "text/plain; charset=utf-8"}
+
+
+@app.route("/admin/config", methods=["GET", "POST"])
+@login_required
+def admin_config():
+    error = None
+    if request.method == "POST":
+        name = request.form.get("name", "")
+        try:
+            SETTINGS.set(name, None if request.form.get("do") == "reset" else request.form.get("value", "").strip())
+        except ValueError as e:
+            error = str(e)
+        else:
+            return redirect(url_for("admin_config"))
+    SETTINGS.refresh()
+    return render_template_string(inject(CONFIG_TEMPLATE), rows=SETTINGS.rows(), error=error,
+                                  check=CONFIG_CHECK_SECONDS), 400 if error else 200
+
+
+@app.get("/admin/profile")
+@login_required
+def admin_profile():
+    try:
+        seconds = float(request.args.get("seconds", "10"))
+    except ValueError:
+        return jsonify({"error": "seconds must be a number"}), 400
+    seconds = max(1.0, min(seconds, PROFILE_MAX_SECONDS))
+
+    if not PROFILE_LOCK.acquire(blocking=False):
+        return jsonify({"error": "a profile capture is already running"}), 409
+    try:
+        log_event(f"Profiler started for {seconds:g}s")
+        # with a watcher process, it samples its own threads alongside this worker
+        capture_id = request_capture(seconds, PROFILE_INTERVAL_MS / 1000) if WATCHER_MODE == "process" else None
+        counts = sample_stacks(seconds, PROFILE_INTERVAL_MS / 1000)
+        if capture_id is not None:
+            watcher = wait_capture(capture_id, 5)
+            counts = {f"web;{k}": v for k, v in counts.items()}
+            if watcher is None:
+                log_event("Profiler: the watcher process did not send its stacks", level="warning")
+            else:
+                counts.update((f"watcher;{k}", v) for k, v in watcher.items())
+    finally:
+        PROFILE_LOCK.release()
+    log_event(f"Profiler finished ({sum(counts.values())} samples)")
+
+    fname = f"tokbot-{datetime.now().strftime('%Y%m%d-%H%M%S')}.collapsed"
+    return collapsed_stacks(counts), 200, {
+        "Content-Type": "text/plain; charset=utf-8",
+        "Content-Disposition": f'attachment; filename="{fname}"',
+    }
+
+
+def supervise_watcher():
+    """Run `app.py watcher` as a child process and restart it if it dies."""
+    cmd = [sys.executable, os.path.abspath(__file__), "watcher"]
+    env = dict(os.environ, WATCHER_MODE="process")
+    stopping = threading.Event()
+    holder = {}
+
+    def loop():
+        backoff = 1
+        while not stopping.is_set():
+            started = time.monotonic()
+            holder["proc"] = subprocess.Popen(cmd, env=env)
+            code = holder["proc"].wait()
+            if stopping.is_set():
+                return
+            backoff = 1 if time.monotonic() - started > 60 else min(backoff * 2, 60)
+            log_event(f"Watcher process exited with {code}, restarting in {backoff}s", level="error", kind="watcher")
+            stopping.wait(backoff)
+
+    def stop():
+        stopping.set()
+        proc = holder.get("proc")
+        if proc and proc.poll() is None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    threading.Thread(target=loop, name="watcher-supervisor", daemon=True).start()
+    return stop
+
+
+def serve(port: int):
+    """
+    Production entry point: gunicorn (gthread) workers serve the dashboard,
+    and exactly one watcher process (owned by the gunicorn master) does the
+    polling. Workers and watcher share state through STATE_PATH / DB_PATH.
+    """
+    from gunicorn.app.base import BaseApplication
+
+    global WATCHER_MODE, EVENT_SPILL
+    WATCHER_MODE, EVENT_SPILL = "process", True
+    os.environ["WATCHER_MODE"] = "process"
+
+    stop_watcher = None
+
+    def when_ready(server):
+        nonlocal stop_watcher
+        stop_watcher = supervise_watcher()
+
+    def on_exit(server):
+        if stop_watcher:
+            stop_watcher()
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for k, v in {
+                "bind": f"0.0.0.0:{port}",
+                "workers": WEB_WORKERS,
+                "threads": WEB_THREADS,
+                "worker_class": "gthread",
+                "accesslog": "-",
+                "when_ready": when_ready,
+                "on_exit": on_exit,
+            }.items():
+                self.cfg.set(k, v)
+
+        def load(self):
+            return app
+
+    Server().run()
+
+
+def run_watcher():
+    """Standalone watcher process (what `serve` supervises)."""
+    global WATCHER_MODE, EVENT_SPILL
+    WATCHER_MODE, EVENT_SPILL = "process", True
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    watcher_loop()
+
+
+def replay(source_id: str, since=None, until=None, rooms=None, digest=None, alert_at=None,
+           speed: float = 0.0, timings: bool = True, out=None):
+    """
+    Run change detection and alerting offline over archived pages of one
+    source, on a simulated clock. Nothing is fetched or sent and the state
+    file is not touched. Writes NDJSON records (page, event, alert, summary)
+    to `out`; with timings=False the output is deterministic for a given
+    archive, so two runs can be diffed.
+    """
+    global CLOCK, EVENT_SPILL
+    out = out or sys.stdout
+    if source_id not in SOURCES:
+        raise SystemExit(f"unknown source {source_id!r} (known: {', '.join(SOURCES)})")
+    src = SOURCES[source_id]
+    rows = archive_index(source_id, since, until)
+    if not rows:
+        raise SystemExit(f"no archived pages for {source_id} in that range (is ARCHIVE_DIR set?)")
+
+    # Subscriptions: one synthetic chat per --rooms entry, else a copy of the live ones
+    if rooms:
+        state = {"subs": {}, "chats": {}}
+        for room in rooms:
+            chat = f"replay:{room}"
+            state["subs"][chat] = {source_id: dict(new_sub(room, True), alert_at=alert_at)}
+            state["chats"][chat] = {"digest": digest}
+    else:
+        live = load_state()
+        state = {"subs": {}, "chats": {}}
+        for chat, by_source in live["subs"].items():
+            if source_id in by_source:
+                sub = dict(by_source[source_id], last_value=None, current_value=None, alert_fired=False)
+                state["subs"][chat] = {source_id: sub}
+                cfg = live["chats"].get(chat, {})
+                state["chats"][chat] = {"digest": digest or cfg.get("digest"), "live": cfg.get("live")}
+    watch = sorted({sub["room"] for _, _, sub in iter_subs(state) if sub.get("enabled") and sub.get("room")})
+
+    def emit(rec):
+        out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+    EVENT_SPILL = False
+    CLOCK = clock = ReplayClock(rows[0][1])
+    seen, alerts, parse_total = EVENTS.seq, 0, 0.0
+    started = time.perf_counter()
+    for _, ts, _, sha, encoding in rows:
+        if speed > 0 and ts > clock.now:
+            time.sleep((ts - clock.now) / speed)
+        clock.advance_to(ts)
+        outbox = collect_digests(state, ts)
+
+        content = archive_get(sha)
+        if content is None:
+            emit({"t": ts, "type": "missing", "sha": sha})
+            continue
+        t0 = time.perf_counter()
+        if src.parser == "anchored":
+            values = parse_anchored(src, content, encoding, watch)
+        else:
+            values = PARSERS[src.parser](content, encoding, watch)
+        parse_ms = (time.perf_counter() - t0) * 1000
+        parse_total += parse_ms
+
+        ok, notices = SELFCHECK.check(src, watch, values)
+        outbox += notices
+        if ok:
+            outbox += apply_board(state, source_id, values)
+        page = {"t": ts, "type": "page", "sha": sha[:12], "values": values}
+        if not ok:
+            page["held"] = True
+        if timings:
+            page["parse_ms"] = round(parse_ms, 3)
+        emit(page)
+        for rec in reversed(EVENTS.page(limit=EVENTS.seq - seen)[0] if EVENTS.seq > seen else []):
+            emit({"t": rec[1], "type": "event", "level": rec[2], "room": rec[3], "kind": rec[4], "msg": rec[5]})
+        seen = EVENTS.seq
+        for chat, text, priority in outbox:
+            alerts += 1
+            emit({"t": ts, "type": "alert", "chat": chat, "priority": PRIORITY_NAMES[priority], "text": text})
+
+    for chat, text, priority in collect_digests(state, float("inf")):
+        alerts += 1
+        emit({"t": clock.now, "type": "alert", "chat": chat, "priority": PRIORITY_NAMES[priority], "text": text,
+              "final": True})
+
+    summary = {"type": "summary", "source": source_id, "pages": len(rows), "alerts": alerts,
+               "simulated_s": round(rows[-1][1] - rows[0][1], 3)}
+    if timings:
+        wall = time.perf_counter() - started
+        summary.update(wall_s=round(wall, 3), parse_ms_total=round(parse_total, 3),
+                       pages_per_s=round(len(rows) / wall, 1) if wall else None)
+    emit(summary)
+    return summary
+
+
+class SinkSMTP(socketserver.StreamRequestHandler):
+    """Just enough SMTP to accept mail and print it (no STARTTLS: use SMTP_STARTTLS=0)."""
+
+    def say(self, line: str):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.say("220 caretrust sink")
+        rcpt, data = [], None
+        for line in self.rfile:
+            if data is not None:
+                if line.rstrip(b"\r\n") == b".":
+                    print(json.dumps({"channel": "email", "to": rcpt, "body": b"".join(data).decode("utf-8", "replace")},
+                                     ensure_ascii=False), flush=True)
+                    rcpt, data = [], None
+                    self.say("250 OK")
+                else:
+                    data.append(line[1:] if line.startswith(b"..") else line)
+                continue
+            cmd = line[:4].upper()
+            if cmd == b"RCPT":
+                rcpt.append(line.decode("utf-8", "replace").split(":", 1)[-1].strip(" <>\r\n"))
+                self.say("250 OK")
+            elif cmd == b"DATA":
+                data = []
+                self.say("354 End data with <CR><LF>.<CR><LF>")
+            elif cmd == b"QUIT":
+                self.say("221 Bye")
+                return
+            else:
+                self.say("250 OK")
+
+
+class SinkWebhook(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            payload = body.decode("utf-8", "replace")
+        print(json.dumps({"channel": "webhook", "path": self.path, "payload": payload}, ensure_ascii=False), flush=True)
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def run_sink(http_port: int, smtp_port: int):
+    """Local stand-in for webhook and SMTP receivers; prints what arrives as NDJSON."""
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    smtp = socketserver.ThreadingTCPServer(("127.0.0.1", smtp_port), SinkSMTP)
+    threading.Thread(target=smtp.serve_forever, name="sink-smtp", daemon=True).start()
+    print(f"sink: webhook on http://127.0.0.1:{http_port}/ , smtp on 127.0.0.1:{smtp_port}", file=sys.stderr)
+    ThreadingHTTPServer(("127.0.0.1", http_port), SinkWebhook).serve_forever()
+
+
+SAVED_PAGE_TYPES = {".html": None, ".htm": None, ".gz": lambda b: zlib.decompress(b, 16 + zlib.MAX_WBITS)}
+SAVED_PAGE_TYPES.update({ext: unpack for ext, _, unpack in CODECS.values()})
+
+
+def read_saved_page(path: str) -> bytes:
+    """A saved page's bytes; archive blobs (.xz/.z) and .gz files are unpacked."""
+    with open(path, "rb") as f:
+        data = f.read()
+    unpack = SAVED_PAGE_TYPES.get(os.path.splitext(path)[1].lower())
+    return unpack(data) if unpack else data
+
+
+def saved_pages(paths, order: str = "name") -> list:
+    """Files named on the command line plus saved pages found under directories, in order."""
+    found = []
+    for path in paths:
+        if not os.path.isdir(path):
+            found.append(path)
+            continue
+        for root, _, names in os.walk(path):
+            found += [os.path.join(root, n) for n in names if os.path.splitext(n)[1].lower() in SAVED_PAGE_TYPES]
+    key = os.path.getmtime if order == "mtime" else None
+    return sorted(dict.fromkeys(found), key=key)
+
+
+def extract_file(path: str, rooms=(), parser: str = "lines", check: bool = False) -> dict:
+    """
+    One saved page -> {room: value}. With no rooms, every label matching
+    ROOM_LABEL_PATTERN is read. "bs4" is the original tree + extract_room_value
+    path; with check=True the "lines" result is compared against it. Runs in
+    pool workers, so errors come back as a record instead of raising.
+    """
+    started = time.perf_counter()
+    try:
+        content = read_saved_page(path)
+        if parser == "bs4":
+            text = html_to_text(content)
+            labels = rooms or [label for label, _ in room_index(page_lines(text)).values()]
+            values = {room: extract_room_value(text, room) for room in labels}
+        elif rooms:
+            values = parse_board(content, None, rooms)
+        else:
+            values = dict(room_index(html_lines(content)).values())
+        rec = {"type": "file", "file": path, "bytes": len(content), "values": values}
+        if check and parser != "bs4":
+            text = html_to_text(content)
+            reference = {room: extract_room_value(text, room) for room in values}
+            rec["mismatches"] = {room: [values[room], ref] for room, ref in reference.items() if values[room] != ref}
+    except Exception as e:
+        rec = {"type": "file", "file": path, "error": f"{type(e).__name__}: {e}"}
+    rec["ms"] = round((time.perf_counter() - started) * 1000, 2)
+    return rec
+
+
+def diff_values(before: dict, after: dict) -> dict:
+    return {
+        "changed": {room: [before[room], v] for room, v in after.items() if room in before and before[room] != v},
+        "added": {room: v for room, v in after.items() if room not in before},
+        "removed": sorted(room for room in before if room not in after),
+    }
+
+
+def extract_batch(paths, rooms=(), parser: str = "lines", workers: int = 0, check: bool = False,
+                  tables: bool = True, timings: bool = True, order: str = "name", out=None):
+    """
+    Parse saved pages offline, spread over `workers` processes (0 = one per
+    core, 1 = in this process). Writes NDJSON in file order: a file record
+    with its room -> value table, a diff record whenever a room differs from
+    the previous file, and a summary with throughput. Nothing touches the
+    store or the state file.
+    """
+    out = out or sys.stdout
+
+    def emit(rec):
+        out.write(json.dumps(rec) + "\n")
+
+    files = saved_pages(paths, order)
+    if not files:
+        raise SystemExit("no saved pages found")
+    workers = workers or os.cpu_count() or 1
+    work = partial(extract_file, rooms=tuple(rooms), parser=parser, check=check)
+    pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) if workers > 1 else None
+    totals = {"files": 0, "errors": 0, "bytes": 0, "diffs": 0, "mismatches": 0}
+    prev, started = None, time.perf_counter()
+    try:
+        results = pool.map(work, files, chunksize=max(1, min(32, len(files) // (workers * 4)))) if pool else map(work, files)
+        for rec in results:
+            totals["files"] += 1
+            if "error" in rec:
+                totals["errors"] += 1
+            else:
+                totals["bytes"] += rec["bytes"]
+                totals["mismatches"] += len(rec.get("mismatches", ()))
+            if not timings:
+                rec.pop("ms")
+            if tables or "error" in rec or rec.get("mismatches"):
+                emit(rec if tables else {k: v for k, v in rec.items() if k != "values"})
+            if "error" in rec:
+                continue
+            if prev is not None:
+                diff = diff_values(prev["values"], rec["values"])
+                if any(diff.values()):
+                    totals["diffs"] += 1
+                    emit({"type": "diff", "from": prev["file"], "to": rec["file"], **diff})
+            prev = rec
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+    summary = {"type": "summary", "parser": parser, "workers": workers, **totals}
+    if not check:
+        del summary["mismatches"]
+    if timings:
+        wall = time.perf_counter() - started
+        summary.update(
+            seconds=round(wall, 3),
+            files_per_s=round(totals["files"] / wall, 1) if wall else None,
+            mb_per_s=round(totals["bytes"] / 2**20 / wall, 2) if wall else None,
+        )
+    emit(summary)
+    out.flush()
+    return summary
+
+
+def rss_mb() -> float:
+    """Current resident set size of this process."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def membench(rooms: int = 300, chats: int = 2000, polls: int = 200, every: int = 20, limit_mb: float = 128, out=None):
+    """
+    Steady-state memory of the watcher's hot path under synthetic load: each
+    poll parses a page of `rooms` rooms, publishes the board and applies it
+    to `chats` subscriptions, every room moving every poll. Runs against a
+    scratch state file and store; nothing is fetched or sent.
+    """
+    global STATE_PATH, DB_PATH, EVENT_SPILL, ARCHIVE_DIR
+    out = out or sys.stdout
+
+    def emit(rec):
+        out.write(json.dumps(rec) + "\n")
+        out.flush()
+
+    scratch = tempfile.mkdtemp(prefix="membench-")
+    STATE_PATH, DB_PATH = os.path.join(scratch, "state.json"), os.path.join(scratch, "bench.db")
+    EVENT_SPILL, ARCHIVE_DIR = False, ""
+    src = SOURCES[default_source_id()]
+    labels = [f"Room {i:02d}" for i in range(1, rooms + 1)]
+    save_state({"update_offset": None, "chats": {}, "subs": {
+        str(100000 + c): {src.id: dict(new_sub(labels[c % rooms], True), alert_at=10**6)} for c in range(chats)
+    }})
+
+    def page(k):
+        rows = "".join(f"<tr><td>{label}</td><td>{k + i}</td></tr>" for i, label in enumerate(labels))
+        return f"<html><head><script>var x=1;</script></head><body><table>{rows}</table></body></html>".encode()
+
+    # what one parse allocates at its peak, tree vs line parser
+    sample = page(0)
+    allocs = {}
+    for name, fn in (("bs4_tree", lambda: html_to_text(sample, "utf-8")), ("text_lines", lambda: html_lines(sample, "utf-8"))):
+        tracemalloc.start()
+        fn()
+        allocs[name] = round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+        tracemalloc.stop()
+    emit({"type": "parse_peak_kib", "page_kib": round(len(sample) / 1024, 1), **allocs})
+
+    samples, started = [], time.perf_counter()
+    emit({"type": "rss", "poll": 0, "rss_mb": round(rss_mb(), 1)})
+    for k in range(1, polls + 1):
+        watch = sub_index().watched.get(src.id, ())
+        values = parse_board(page(k), "utf-8", watch)
+        BOARD.publish(src.id, values)
+        with edit_state() as state:
+            apply_board(state, src.id, values, sub_index())
+        if k % every == 0 or k == polls:
+            samples.append(rss_mb())
+            emit({"type": "rss", "poll": k, "rss_mb": round(samples[-1], 1)})
+    wall = time.perf_counter() - started
+
+    steady = sorted(samples[len(samples) // 2:])
+    summary = {
+        "type": "summary", "rooms": rooms, "chats": chats, "polls": polls,
+        "steady_rss_mb": round(steady[len(steady) // 2], 1), "last_rss_mb": round(samples[-1], 1),
+        "growth_mb": round(samples[-1] - steady[0], 1), "limit_mb": limit_mb,
+        "ms_per_poll": round(wall / polls * 1000, 1),
+    }
+    summary["within_limit"] = summary["last_rss_mb"] < limit_mb
+    emit(summary)
+    return summary
+
+
+def parse_when(value: str) -> float:
+    """Epoch seconds or an ISO date/time (local time)."""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CareTrust token monitor")
+    sub = parser.add_subparsers(dest="mode", metavar="mode")
+    sub.add_parser("dev", help="Flask dev server + watcher thread (default)")
+    sub.add_parser("serve", help="production WSGI + watcher process")
+    sub.add_parser("watcher", help="watcher only")
+
+    rp = sub.add_parser("replay", help="replay archived pages through change detection offline")
+    rp.add_argument("--source", default=None, help="source id (default: the default source)")
+    rp.add_argument("--since", type=parse_when, help="epoch seconds or ISO time")
+    rp.add_argument("--until", type=parse_when, help="epoch seconds or ISO time")
+    rp.add_argument("--rooms", help="comma separated rooms to watch (default: current subscriptions)")
+    rp.add_argument("--digest", type=int, help="digest window in minutes for the replayed chats")
+    rp.add_argument("--alert-at", type=int, help="/alertat threshold for --rooms chats")
+    rp.add_argument("--speed", type=float, default=0.0, help="N x real time; 0 = as fast as possible")
+    rp.add_argument("--no-timings", action="store_true", help="omit timings so runs can be diffed")
+    rp.add_argument("--out", help="write NDJSON here instead of stdout")
+
+    sk = sub.add_parser("sink", help="local webhook + SMTP receiver for testing notifiers")
+    sk.add_argument("--http", type=int, default=8025)
+    sk.add_argument("--smtp", type=int, default=1025)
+
+    mb = sub.add_parser("membench", help="steady-state RSS of the poll/apply path under synthetic load")
+    mb.add_argument("--rooms", type=int, default=300)
+    mb.add_argument("--chats", type=int, default=2000)
+    mb.add_argument("--polls", type=int, default=200)
+    mb.add_argument("--limit-mb", type=float, default=128)
+
+    ex = sub.add_parser("extract", help="parse saved HTML pages offline in parallel; tables and diffs as NDJSON")
+    ex.add_argument("paths", nargs="+", help="saved pages (.html/.htm, archive .xz/.z, .gz) or directories")
+    ex.add_argument("--rooms", help="comma separated rooms (default: every room label on each page)")
+    ex.add_argument("--parser", choices=("lines", "bs4"), default="lines")
+    ex.add_argument("--workers", type=int, default=0, help="processes; 0 = one per core, 1 = no pool")
+    ex.add_argument("--check", action="store_true", help="compare each value against the bs4 reference")
+    ex.add_argument("--order", choices=("name", "mtime"), default="name", help="what 'consecutive' means for diffs")
+    ex.add_argument("--no-tables", action="store_true", help="diffs, errors, mismatches and summary only")
+    ex.add_argument("--no-timings", action="store_true", help="omit timings so runs can be diffed")
+    ex.add_argument("--out", help="write NDJSON here instead of stdout")
+
+    args = parser.parse_args(argv)
     port = int(os.environ.get("PORT", "8080"))
-    app.run(host="0.0.0.0", port=port)
+
+    if args.mode == "serve":
+        serve(port)
+    elif args.mode == "watcher":
+        run_watcher()
+    elif args.mode == "membench":
+        membench(args.rooms, args.chats, args.polls, max(1, args.polls // 10), args.limit_mb)
+    elif args.mode == "extract":
+        rooms = [r.strip() for r in args.rooms.split(",") if r.strip()] if args.rooms else ()
+        out = open(args.out, "w", encoding="utf-8") if args.out else sys.stdout
+        try:
+            extract_batch(args.paths, rooms, args.parser, args.workers, args.check,
+                          not args.no_tables, not args.no_timings, args.order, out)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+    elif args.mode == "sink":
+        run_sink(args.http, args.smtp)
+    elif args.mode == "replay":
+        if args.source and args.source not in SOURCES:
+            rp.error(f"unknown source {args.source!r} (known: {', '.join(SOURCES)})")
+        rooms = [r.strip() for r in args.rooms.split(",") if r.strip()] if args.rooms else None
+        out = open(args.out, "w", encoding="utf-8") if args.out else sys.stdout
+        try:
+            replay(args.source or default_source_id(), args.since, args.until, rooms,
+                   args.digest, args.alert_at, args.speed, not args.no_timings, out)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+    else:
+        threading.Thread(target=watcher_loop, name="watcher", daemon=True).start()
+        app.run(host="0.0.0.0", port=port)
+
+
+if __name__ == "__main__":
+    main()
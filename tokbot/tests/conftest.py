@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# app.py reads its configuration at import; point its state and store at a scratch directory
+os.environ.setdefault("STATE_PATH", os.path.join(tempfile.mkdtemp(prefix="tokbot-tests-"), "state.json"))
+os.environ.setdefault("DASH_PASS", "test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+import app
+
+
+class FakeNotifier(app.Notifier):
+    name = "fake"
+    rate = 1000.0
+
+    def send(self, address, texts):
+        raise AssertionError("the tests drive take/done themselves")
+
+
+@pytest.fixture
+def outbox(monkeypatch):
+    monkeypatch.setitem(app.NOTIFIERS, "fake", FakeNotifier())
+    monkeypatch.setattr(app, "OUTBOX_CHAT_INTERVAL", 0)
+    monkeypatch.setattr(app, "OUTBOX_MAX_TRIES", 3)
+    ob = app.Outbox()
+    ob.pid = os.getpid()  # no sender threads: the tests call take/done
+    return ob
+
+
+def take(ob):
+    """take() without waiting out the backoff done() leaves behind."""
+    assert ob.size, "nothing queued; take() would block"
+    ob.ready_at.clear()
+    return ob.take()
+
+
+def stored(dest):
+    return app.db().execute("SELECT text, tries FROM outbox WHERE dest = ? ORDER BY id", (dest,)).fetchall()
+
+
+def test_more_urgent_class_goes_first(outbox):
+    outbox.put("fake:prio-a", "change", app.CHANGE)
+    outbox.put("fake:prio-b", "reply", app.REPLY)
+    outbox.put("fake:prio-c", "urgent", app.URGENT)
+    order = []
+    while outbox.size:
+        notifier, address, batch = take(outbox)
+        order.append(batch[0][1])
+        outbox.done(notifier, batch, True)
+    assert order == ["urgent", "change", "reply"]
+
+
+def test_destinations_take_turns(outbox):
+    for text in ("a1", "a2", "a3"):
+        outbox.put("fake:rr-a", text)
+    for text in ("b1", "b2"):
+        outbox.put("fake:rr-b", text)
+    order = []
+    while outbox.size:
+        notifier, address, batch = take(outbox)
+        order.append(batch[0][1])
+        outbox.done(notifier, batch, True)
+    assert order == ["a1", "b1", "a2", "b2", "a3"]
+    assert stored("fake:rr-a") == stored("fake:rr-b") == []
+
+
+def test_failed_send_is_retried_then_dropped(outbox):
+    outbox.put("fake:retry", "hello")
+    for tries in range(1, app.OUTBOX_MAX_TRIES):
+        notifier, address, batch = take(outbox)
+        assert batch[0][1] == "hello"
+        outbox.done(notifier, batch, False)
+        assert outbox.size == 1
+        assert stored("fake:retry") == [("hello", tries)]
+    notifier, address, batch = take(outbox)
+    outbox.done(notifier, batch, False)
+    assert outbox.size == 0
+    assert stored("fake:retry") == []
+    status = app.db().execute(
+        "SELECT status, tries FROM deliveries WHERE chat = 'fake:retry' ORDER BY id DESC LIMIT 1").fetchone()
+    assert status == ("dropped", app.OUTBOX_MAX_TRIES)
+
+
+def test_not_attempted_send_keeps_its_place_and_tries(outbox):
+    outbox.put("fake:requeue", "first")
+    outbox.put("fake:requeue", "second")
+    notifier, address, batch = take(outbox)
+    outbox.done(notifier, batch, None)
+    assert outbox.size == 2
+    notifier, address, batch = take(outbox)
+    assert [item[1:3] for item in batch] == [["first", 0]]
+    outbox.done(notifier, batch, True)
+    assert stored("fake:requeue") == [("second", 0)]
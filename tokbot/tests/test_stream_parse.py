@@ -0,0 +1,43 @@
+import pytest
+
+import app
+
+ROOMS = [f"Room {i}" for i in range(1, 400)]
+
+
+def page() -> str:
+    rows = "".join(
+        f"<tr><td>{room}</td><td>Token {1000 + i} &amp; up</td></tr>\n" for i, room in enumerate(ROOMS, 1)
+    )
+    return (
+        "<html><head><style>td { color: red }</style><script>var x = '<td>Room 1</td>';</script></head>"
+        f"<body><h1>Token status</h1><!-- generated --><table>\n{rows}</table>"
+        "<p>Dental OPD:\r\n 7</p></body></html>"
+    )
+
+
+def feed(parser, text: str, size: int):
+    for i in range(0, len(text), size):
+        parser.feed(text[i:i + size])
+    parser.close()
+    return parser
+
+
+@pytest.mark.parametrize("size", [1, 7, 13, 64, 8192])
+def test_chunked_lines_match_whole_page(size):
+    text = page()
+    assert feed(app.TextLines(), text, size).lines == app.html_lines(text)
+
+
+@pytest.mark.parametrize("size", [7, 13, 8192])
+def test_room_stream_matches_parse_board(size):
+    text = page()
+    rooms = ROOMS + ["Dental OPD", "Room 999"]
+    expected = app.parse_board(text.encode(), "utf-8", rooms)
+    assert expected["Room 358"] == "Token 1358 & up"
+    assert feed(app.RoomStream(rooms), text, size).values == {r: v for r, v in expected.items() if v is not None}
+
+
+def test_lines_follow_tags_and_newlines():
+    text = "<p>Room 3<b>9</b></p>line one\nline two<br/>tail"
+    assert feed(app.TextLines(), text, 3).lines == ["Room 3", "9", "line one", "line two", "tail"]